@@ -0,0 +1,263 @@
+"""
+Streaming statistics of a sample of soldiers.
+
+A sample is fed in chunks of stat deltas, so that it never has to be in
+memory all at once. Everything is kept as integer counts and sums:
+a histogram of every stat, of every pair of stats and of the weighed stat
+totals, and sums of products of every pair of columns for the covariances.
+Each chunk is counted with one `np.bincount` per histogram, so the cost
+doesn't grow with the number of values a stat can have. Integers add up
+exactly, so accumulators of different chunks or workers can be merged
+in any order and give the same result as one pass over the whole sample.
+"""
+from itertools import combinations
+from statistics import NormalDist
+
+import numpy as np
+from numpy.typing import NDArray
+
+from batch import (
+    BLOCK_SIZE,
+    MIN_DELTAS,
+    MIN_TOTAL,
+    SPANS,
+    STAT_NAMES,
+    TOTALS_SPAN,
+    iter_deltas,
+    weighed_stat_totals,
+)
+from cache import cached_deltas
+from soldier import Soldier, StatSwapper
+
+
+class StatisticsAccumulator:
+    """
+    Running statistics of the soldiers in every chunk passed to `update`.
+    The histograms are counts indexed like the distributions of
+    `exact.ExactDistribution`, by stat delta minus `min_delta`.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.marginals = {
+            stat: np.zeros(span, dtype=np.int64)
+            for stat, span in zip(STAT_NAMES, SPANS)
+        }
+        self.joints = {
+            (stat_1, stat_2): np.zeros([SPANS[i], SPANS[j]], dtype=np.int64)
+            for (i, stat_1), (j, stat_2) in combinations(enumerate(STAT_NAMES), 2)
+        }
+        self.totals = np.zeros(TOTALS_SPAN, dtype=np.int64)  # Minus MIN_TOTAL
+        # Over the stat deltas followed by the weighed stat total
+        self.sums = np.zeros(len(STAT_NAMES) + 1, dtype=np.int64)
+        self.products = np.zeros([len(STAT_NAMES) + 1] * 2, dtype=np.int64)
+
+    def update(self, deltas: NDArray) -> "StatisticsAccumulator":
+        """Add an (n, 7) array of stat deltas to the statistics"""
+        totals = weighed_stat_totals(deltas.astype(np.int64))
+        offsets = (deltas - MIN_DELTAS).T.copy()  # One contiguous row per stat
+        for i, stat in enumerate(STAT_NAMES):
+            self.marginals[stat] += np.bincount(offsets[i], minlength=SPANS[i])
+        for (i, stat_1), (j, stat_2) in combinations(enumerate(STAT_NAMES), 2):
+            self.joints[stat_1, stat_2] += np.bincount(
+                offsets[i] * SPANS[j] + offsets[j], minlength=SPANS[i] * SPANS[j]
+            ).reshape(SPANS[i], SPANS[j])
+        self.totals += np.bincount(totals - MIN_TOTAL, minlength=TOTALS_SPAN)
+
+        columns = np.column_stack([deltas, totals]).astype(float)
+        self.count += len(deltas)
+        self.sums += columns.sum(0).astype(np.int64)
+        # Exact as long as a chunk's sums stay below 2**53
+        self.products += np.rint(columns.T @ columns).astype(np.int64)
+        return self
+
+    def merge(self, other: "StatisticsAccumulator") -> "StatisticsAccumulator":
+        """Add the statistics of `other` to these"""
+        self.count += other.count
+        for stat in STAT_NAMES:
+            self.marginals[stat] += other.marginals[stat]
+        for pair in self.joints:
+            self.joints[pair] += other.joints[pair]
+        self.totals += other.totals
+        self.sums += other.sums
+        self.products += other.products
+        return self
+
+    def values(self, stat: str) -> range:
+        """The stat values the histogram of `stat` is indexed by"""
+        range_ = Soldier.STATS[stat]
+        return range(
+            range_.default + range_.min_delta, range_.default + range_.max_delta + 1
+        )
+
+    def joint(self, stat_1: str, stat_2: str) -> NDArray:
+        """The joint histogram of two stats, indexed by [stat_1, stat_2]"""
+        if (stat_1, stat_2) in self.joints:
+            return self.joints[stat_1, stat_2]
+        return self.joints[stat_2, stat_1].T
+
+    def columns(self, totals=False) -> list[tuple[NDArray, NDArray]]:
+        """
+        (values, counts) of every stat, in the same order as the
+        columns of `main.generate_sample`, optionally with weighed stat totals
+        """
+        columns = [
+            (np.array(self.values(stat)), self.marginals[stat]) for stat in STAT_NAMES
+        ]
+        if totals:
+            columns.append((np.arange(TOTALS_SPAN) + MIN_TOTAL, self.totals))
+        return columns
+
+    def mean(self, totals=False) -> NDArray:
+        return np.array(
+            [counts @ values / self.count for values, counts in self.columns(totals)]
+        )
+
+    def moment(self, order: int, totals=False) -> NDArray:
+        """Central moments of every stat"""
+        return np.array(
+            [
+                counts @ (values - mean) ** order / self.count
+                for (values, counts), mean in zip(
+                    self.columns(totals), self.mean(totals)
+                )
+            ]
+        )
+
+    def variance(self, totals=False) -> NDArray:
+        """Unbiased sample variance, like `np.cov`"""
+        return self.moment(2, totals) * self.count / (self.count - 1)
+
+    def skewness(self, totals=False) -> NDArray:
+        """Biased sample skewness, like `scipy.stats.skew`"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.moment(3, totals) / self.moment(2, totals) ** 1.5
+
+    def kurtosis(self, totals=False) -> NDArray:
+        """Biased excess kurtosis, like `scipy.stats.kurtosis`"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.moment(4, totals) / self.moment(2, totals) ** 2 - 3
+
+    def covariance(self, totals=False) -> NDArray:
+        """Unbiased sample covariance matrix, like `np.cov`"""
+        size = len(STAT_NAMES) + bool(totals)
+        sums = self.sums[:size].astype(float)
+        products = self.products[:size, :size].astype(float)
+        return (products - np.outer(sums, sums) / self.count) / (self.count - 1)
+
+    def correlation(self, totals=False) -> NDArray:
+        cov = self.covariance(totals)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return cov / np.sqrt(np.outer(cov.diagonal(), cov.diagonal()))
+
+    def standard_errors(self, totals=False) -> NDArray:
+        """Standard errors of the means of every stat"""
+        return np.sqrt(self.variance(totals) / self.count)
+
+    def half_widths(self, confidence=0.95, totals=False) -> dict[str, NDArray]:
+        """
+        Half-widths of confidence intervals of the means, in the units of
+        every stat, from its sample standard deviation; of the probability
+        of every histogram bin (Wilson intervals, which don't shrink to
+        nothing for empty bins); and of every correlation between two
+        different stats (Fisher's z)
+        """
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        n = self.count
+        probabilities = np.concatenate(
+            [counts / n for __, counts in self.columns(totals)]
+        )
+        correlation = self.correlation()[np.triu_indices(len(STAT_NAMES), 1)]
+        with np.errstate(invalid="ignore"):
+            correlation_widths = np.tanh(z / np.sqrt(n - 3)) * (1 - correlation**2)
+        return {
+            "mean": z * self.standard_errors(totals),
+            "probability": z
+            / (1 + z**2 / n)
+            * np.sqrt(probabilities * (1 - probabilities) / n + z**2 / (4 * n**2)),
+            # Stats that never change have no correlation to be unsure about
+            "correlation": np.nan_to_num(correlation_widths),
+        }
+
+
+def sample_statistics(
+    initializer: StatSwapper,
+    n: int,
+    seed: int | np.random.SeedSequence | None = None,
+    workers: int = 1,
+    cache: bool = False,
+    backend: str = "numpy",
+) -> StatisticsAccumulator:
+    """
+    Statistics of the same sample as `main.generate_sample`,
+    rolled and accumulated one block at a time.
+    With `cache` and a `seed`, the blocks are read from and saved to the cache.
+    """
+    if cache and seed is not None:
+        return accumulate(cached_deltas(initializer, n, seed, workers, backend=backend))
+    return accumulate(iter_deltas(initializer, n, seed, workers, backend=backend))
+
+
+def precise_statistics(
+    initializer: StatSwapper,
+    precision: dict[str, float],
+    seed: int | np.random.SeedSequence | None = None,
+    workers: int = 1,
+    confidence: float = 0.95,
+    max_n: int | None = None,
+    totals: bool = False,
+    backend: str = "numpy",
+) -> StatisticsAccumulator:
+    """
+    Statistics of a sample that grows in rounds until the half-widths of
+    `StatisticsAccumulator.half_widths` of every kind in `precision`, like
+    "mean", are at most the precision given for it, or the sample has
+    `max_n` soldiers. Every round rolls whole blocks on from the last one,
+    so like in `batch.iter_deltas`, only a `max_n` that isn't a multiple of
+    `BLOCK_SIZE` ends in a block of its own.
+    """
+    if not precision or min(precision.values()) <= 0:
+        raise ValueError("precision needs positive half-widths to reach")
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)  # The same stream every round
+    accumulator = StatisticsAccumulator()
+    n = BLOCK_SIZE
+    while True:
+        if max_n is not None:
+            n = min(n, max_n)
+        for deltas in iter_deltas(
+            initializer, n, seed, workers, accumulator.count, backend=backend
+        ):
+            accumulator.update(deltas)
+
+        half_widths = accumulator.half_widths(confidence, totals)
+        # How many times too wide the widest half-width of any kind is
+        widest = max(
+            half_widths[kind].max(initial=0) / target
+            for kind, target in precision.items()
+        )
+        if widest <= 1 or n == max_n:
+            return accumulator
+        # Half-widths shrink like 1 / sqrt(n)
+        needed = n * widest**2
+        n = int(min(max(needed, n + BLOCK_SIZE), 4 * n))
+        n = -(-n // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def array_statistics(deltas: NDArray) -> StatisticsAccumulator:
+    """
+    Statistics of an (n, 7) array of stat deltas, taken a block at a time,
+    so that a memory-mapped array is never read into memory all at once
+    """
+    return accumulate(
+        deltas[start : start + BLOCK_SIZE]
+        for start in range(0, len(deltas), BLOCK_SIZE)
+    )
+
+
+def accumulate(chunks) -> StatisticsAccumulator:
+    """Statistics of every chunk of stat deltas in `chunks`"""
+    accumulator = StatisticsAccumulator()
+    for deltas in chunks:
+        accumulator.update(deltas)
+    return accumulator
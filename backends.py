@@ -0,0 +1,192 @@
+"""
+Backends that roll soldiers.
+
+Every backend rolls `n` soldiers with any `StatSwapper` into an (n, 7)
+array of stat deltas, drawing from a NumPy generator, optionally with
+a fixed number of swaps `rolls` for every soldier:
+
+* "reference" builds one `Soldier` at a time, like the mod does,
+* "numpy" rolls the whole sample at once with `batch.generate_deltas`,
+* "numba" runs the per-soldier loop compiled with Numba, if it's installed.
+
+They roll the same distribution, but not the same soldiers for a seed.
+"auto" is the fastest backend that is installed, so its soldiers for a
+seed depend on what's installed; only asking for a backend by name, like
+main.py's default of "numpy", gives the same soldiers everywhere.
+The distributions of every backend can be checked against the
+reference's with
+
+    python backends.py --initializer lwotc -n 20000
+"""
+import argparse
+import random
+import sys
+from collections import namedtuple
+from importlib.util import find_spec
+
+import numpy as np
+from numpy.typing import NDArray
+
+from batch import (
+    MIN_DELTAS,
+    MIN_TOTAL,
+    SPANS,
+    STAT_NAMES,
+    generate_deltas,
+    weighed_stat_totals,
+)
+from soldier import INITIALIZERS, Soldier, StatSwapper
+
+Backend = namedtuple("Backend", ("name", "generate", "available"))
+
+
+def reference_deltas(
+    initializer: StatSwapper,
+    n: int,
+    rng: int | np.random.SeedSequence | np.random.Generator | None = None,
+    rolls: int | None = None,
+) -> NDArray:
+    """
+    `batch.generate_deltas` by building one `Soldier` at a time,
+    drawing from a `random.Random` seeded from `rng`, a generator or
+    anything `np.random.default_rng` takes
+    """
+    rng = np.random.default_rng(rng)
+    # Its own generator, so that the `random` module isn't reseeded
+    soldier_rng = random.Random(int(rng.integers(2**63)))
+    if rolls is not None:
+        # Dice with one side always sum to the number of dice
+        initializer = StatSwapper((1,) * rolls, initializer.swap_table)
+    sample = np.zeros([n, len(Soldier.STATS)], dtype=np.int16)
+    for i in range(n):
+        sol = Soldier()
+        initializer(sol, soldier_rng)
+        sample[i] = [
+            getattr(sol, stat).current - range_.default
+            for stat, range_ in Soldier.STATS.items()
+        ]
+    return sample
+
+
+def numba_deltas(initializer, n, rng=None, rolls=None) -> NDArray:
+    """`batch.generate_deltas` in compiled code"""
+    from numba_backend import generate_deltas
+
+    return generate_deltas(initializer, n, rng, rolls)
+
+
+BACKENDS = {
+    "reference": Backend("reference", reference_deltas, True),
+    "numpy": Backend("numpy", generate_deltas, True),
+    "numba": Backend("numba", numba_deltas, find_spec("numba") is not None),
+}
+# From the fastest to the slowest
+PREFERENCE = ("numba", "numpy", "reference")
+# Least number of soldiers expected with a value for `check` to test it alone
+MIN_EXPECTED = 5
+
+
+def get_backend(name: str = "numpy") -> Backend:
+    """The backend called `name`, or the fastest available one for "auto" """
+    if name == "auto":
+        name = next(name for name in PREFERENCE if BACKENDS[name].available)
+    if name not in BACKENDS:
+        raise ValueError(f"unknown backend {name!r}")
+    if not BACKENDS[name].available:
+        raise ValueError(f"backend {name!r} is not installed")
+    return BACKENDS[name]
+
+
+def check(
+    backend: str,
+    initializer: StatSwapper,
+    n: int,
+    seed: int | None = None,
+    reference: NDArray | None = None,
+) -> dict[str, float]:
+    """
+    p-values of chi-square tests of whether `n` soldiers of `backend` and
+    `n` of the reference backend have the same distribution of every stat
+    and of the weighed stat totals
+    """
+    from scipy.stats import chi2_contingency
+
+    backend_seed, reference_seed = np.random.SeedSequence(seed).spawn(2)
+    sample = get_backend(backend).generate(initializer, n, backend_seed)
+    if reference is None:
+        reference = reference_deltas(initializer, n, reference_seed)
+
+    p_values = {}
+    for i, stat in enumerate(STAT_NAMES + ["WeighedStatTotal"]):
+        if i < len(STAT_NAMES):
+            columns = [deltas[:, i] - MIN_DELTAS[i] for deltas in (sample, reference)]
+            span = SPANS[i]
+        else:
+            columns = [
+                weighed_stat_totals(deltas.astype(np.int64)) - MIN_TOTAL
+                for deltas in (sample, reference)
+            ]
+            span = max(column.max(initial=0) for column in columns) + 1
+        table = np.array([np.bincount(column, minlength=span) for column in columns])
+        # Rare values are lumped together, since the test needs a few of each
+        rare = table.sum(0) < MIN_EXPECTED * len(table)
+        table = np.column_stack([table[:, ~rare], table[:, rare].sum(1)])
+        table = table[:, table.sum(0) > 0]
+        # A stat that never changes can't be told apart
+        p_values[stat] = chi2_contingency(table).pvalue if table.shape[1] > 1 else 1.0
+    return p_values
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("python backends.py")
+    parser.add_argument(
+        "--initializer",
+        choices=INITIALIZERS,
+        nargs="+",
+        default=list(INITIALIZERS),
+        help="Initializers to check the backends with",
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        default=20_000,
+        help="Number of soldiers to compare per backend and initializer",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=0.01,
+        help="Significance level of all the tests together",
+    )
+    args = parser.parse_args()
+
+    backends = [
+        name
+        for name, backend in BACKENDS.items()
+        if backend.available and name != "reference"
+    ]
+    results = {}
+    for name in args.initializer:
+        initializer = INITIALIZERS[name]
+        # The same reference sample as `check` rolls, rolled once for every backend
+        reference_seed = np.random.SeedSequence(args.seed).spawn(2)[1]
+        reference = reference_deltas(initializer, args.number, reference_seed)
+        for backend in backends:
+            results[name, backend] = check(
+                backend, initializer, args.number, args.seed, reference
+            )
+    # Bonferroni-corrected, since every stat of every pair is a test
+    level = args.alpha / sum(len(p_values) for p_values in results.values())
+    failed = False
+    for (name, backend), p_values in results.items():
+        smallest = min(p_values, key=lambda stat: p_values[stat])
+        status = "ok" if p_values[smallest] >= level else "FAIL"
+        failed |= status == "FAIL"
+        print(
+            f"{name:<8} {backend:<10} {status:<5} "
+            f"lowest p = {p_values[smallest]:.3g} ({smallest})"
+        )
+    if failed:
+        sys.exit(1)
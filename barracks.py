@@ -0,0 +1,582 @@
+"""
+A persistent columnar store of generated soldiers.
+
+A barracks is a directory of samples, each the soldiers of one initializer
+and seed as rolled by `batch.iter_deltas`, tagged by both. Soldier `i` of a
+sample is soldier `i` of any sample of whole blocks of `batch.BLOCK_SIZE`
+of the same seed. A sample is stored in segments of at most `SEGMENT_SIZE`
+soldiers, with one .npy file per column: an int8 one per stat delta of
+`Soldier.STATS`, and an int16 one of the weighed stat totals. More
+soldiers of a sample can be added later, and continue where the stored
+ones end.
+
+Every sample also has a count index: the sorted list of every combination
+of stats its soldiers have, with how many have it, so `Barracks.count`
+answers conjunctive range queries and counts grouped by initializer, seed
+or column from the index alone, without reading any soldier. The list is
+also ordered by the value of every column, so a query only reads the
+combinations in the range of its most selective condition. The index
+takes about `INDEX_BYTES` per combination: LWOTC soldiers only have a
+couple of million, so their queries take no longer for more soldiers, but
+soldiers of the ANCE tables nearly all differ, so their index grows about
+as large as the soldiers.
+
+    python barracks.py soldiers add --initializer lwotc -n 100000000 --seed 0
+    python barracks.py soldiers count "Offense>=70" "Mobility>=16" --by initializer
+"""
+import argparse
+import json
+import os
+import shutil
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+from numpy.typing import NDArray
+
+from batch import (
+    BLOCK_SIZE,
+    MIN_DELTAS,
+    MIN_TOTAL,
+    SPANS,
+    STAT_NAMES,
+    TOTALS_SPAN,
+    WEIGHTS,
+    SoldierBatch,
+    iter_deltas,
+    weighed_stat_totals,
+)
+from cache import cache_key
+from rare import parse_condition
+from soldier import INITIALIZERS, Soldier, Stat
+
+# Bump when the layout of the files changes
+BARRACKS_VERSION = 1
+# Soldiers per segment, a multiple of `BLOCK_SIZE`
+SEGMENT_SIZE = 1 << 24
+# Positions in the list of combinations, enough for every possible one
+ORDER_TYPE = np.uint32
+# Combinations of an index read at once
+CHUNK_SIZE = 1 << 22
+TOTAL_COLUMN = "WeighedStatTotal"
+COLUMNS = STAT_NAMES + [TOTAL_COLUMN]
+COLUMN_TYPES = dict.fromkeys(STAT_NAMES, np.int8) | {TOTAL_COLUMN: np.int16}
+# What conditions can be on, in the values `parse_condition` reads
+COLUMN_RANGES = Soldier.STATS | {
+    TOTAL_COLUMN: Stat(0, MIN_TOTAL, MIN_TOTAL + TOTALS_SPAN - 1)
+}
+# Disk space of a combination in an index: its code, count, columns,
+# and position in the order by every column
+INDEX_BYTES = 16 + sum(
+    np.dtype(column_type).itemsize + np.dtype(ORDER_TYPE).itemsize
+    for column_type in COLUMN_TYPES.values()
+)
+# What samples are tagged by, which `Barracks.count` can also group by
+TAGS = ("initializer", "seed")
+
+
+def combination_codes(deltas: NDArray) -> NDArray:
+    """A number for the combination of stat deltas of every soldier"""
+    return np.ravel_multi_index((deltas - MIN_DELTAS).T, SPANS)
+
+
+def combination_columns(codes: NDArray) -> dict[str, NDArray]:
+    """The column of every combination of `codes`, as deltas"""
+    columns = {
+        stat: (offsets + MIN_DELTAS[i]).astype(COLUMN_TYPES[stat])
+        for i, (stat, offsets) in enumerate(
+            zip(STAT_NAMES, np.unravel_index(codes, SPANS))
+        )
+    }
+    columns[TOTAL_COLUMN] = sum(
+        WEIGHTS[i] * columns[stat].astype(np.int16) for i, stat in enumerate(STAT_NAMES)
+    ).astype(np.int16)
+    return columns
+
+
+def merge_counts(parts) -> tuple[NDArray, NDArray]:
+    """The sorted combinations of every (codes, counts) of `parts`, counted together"""
+    codes = np.concatenate([codes for codes, __ in parts])
+    counts = np.concatenate([counts for __, counts in parts])
+    unique, inverse = np.unique(codes, return_inverse=True)
+    return unique, np.bincount(inverse.ravel(), counts, len(unique)).astype(np.int64)
+
+
+def count_combinations(chunks) -> tuple[NDArray, NDArray]:
+    """The sorted combinations of the stat deltas of every chunk, and their counts"""
+    merged = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    pending, pending_size = [], 0
+    for deltas in chunks:
+        pending.append(np.unique(combination_codes(deltas), return_counts=True))
+        pending_size += len(pending[-1][0])
+        # Merged once there are as many pending as merged, so that every
+        # combination is only merged a few times
+        if pending_size >= len(merged[0]):
+            merged = merge_counts([merged, *pending])
+            pending, pending_size = [], 0
+    return merge_counts([merged, *pending])
+
+
+def value_offsets(values: NDArray, column: str) -> NDArray:
+    """
+    Where every delta of `column` starts among the sorted `values`,
+    and where the last one ends
+    """
+    range_ = COLUMN_RANGES[column]
+    span = range_.max_delta - range_.min_delta + 1
+    offsets = np.zeros(span + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(values - range_.min_delta, minlength=span))
+    return offsets
+
+
+def delta_slice(column: str, lowest: int, highest: int) -> slice:
+    """The positions in `value_offsets` of the values from `lowest` to `highest`"""
+    range_ = COLUMN_RANGES[column]
+    span = range_.max_delta - range_.min_delta + 1
+    offset = range_.default + range_.min_delta
+    return slice(
+        min(max(lowest - offset, 0), span), min(max(highest - offset + 1, 0), span)
+    )
+
+
+def in_range(values: NDArray, column: str, lowest: int, highest: int) -> NDArray:
+    """Which deltas of `column` are of values from `lowest` to `highest`"""
+    range_ = COLUMN_RANGES[column]
+    # Clipped to the range of the column, so that the bounds fit its type
+    low = max(lowest - range_.default, range_.min_delta)
+    high = min(highest - range_.default, range_.max_delta)
+    return (values >= low) & (values <= high)
+
+
+class Barracks:
+    """The barracks in the directory `path`, which is created once soldiers are added"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            manifest = json.loads((self.path / "manifest.json").read_text())
+        except FileNotFoundError:
+            manifest = {"version": BARRACKS_VERSION, "columns": COLUMNS, "samples": []}
+        if manifest["version"] != BARRACKS_VERSION or manifest["columns"] != COLUMNS:
+            raise ValueError(f"{self.path} was stored by another version")
+        self.samples = manifest["samples"]
+        self._indexes = {}
+
+    def __len__(self) -> int:
+        return sum(sample["count"] for sample in self.samples)
+
+    def _save(self):
+        manifest = {"version": BARRACKS_VERSION, "columns": COLUMNS}
+        manifest["samples"] = self.samples
+        # Written under another name first, so that readers never see half a file
+        temporary = self.path / f"manifest.{os.getpid()}.tmp"
+        temporary.write_text(json.dumps(manifest, indent=1))
+        os.replace(temporary, self.path / "manifest.json")
+
+    def sample(self, initializer: str, seed: int) -> dict | None:
+        """The sample of `initializer` and `seed`, if any of its soldiers are stored"""
+        return next(
+            (
+                sample
+                for sample in self.samples
+                if (sample["initializer"], sample["seed"]) == (initializer, seed)
+            ),
+            None,
+        )
+
+    def _samples(self, initializer: str | None = None, seed: int | None = None):
+        return [
+            sample
+            for sample in self.samples
+            if sample["count"]
+            and initializer in (None, sample["initializer"])
+            and seed in (None, sample["seed"])
+        ]
+
+    def _directory(self, sample: dict) -> Path:
+        return self.path / f"{sample['initializer']}-{sample['seed']}"
+
+    def add(
+        self,
+        initializer: str,
+        n: int,
+        seed: int,
+        workers: int = 1,
+        backend: str = "numpy",
+    ) -> int:
+        """
+        Roll and store `n` more soldiers of the sample of the initializer
+        called `initializer` and `seed`, after those already stored.
+        Returns the index in the sample of the first one.
+        """
+        from backends import get_backend
+
+        backend = get_backend(backend).name
+        key = cache_key(INITIALIZERS[initializer], seed, backend)
+        sample = self.sample(initializer, seed)
+        if sample is None:
+            sample = {"initializer": initializer, "seed": seed, "backend": backend}
+            sample |= {"key": key, "count": 0, "segments": []}
+            sample |= {"indexed": 0}
+            self.samples.append(sample)
+        elif sample["key"] != key:
+            raise ValueError(
+                f"the {initializer} soldiers of seed {seed} were rolled with "
+                "another swap table or backend"
+            )
+        elif sample["indexed"] != sample["count"]:
+            self._reindex(sample)
+
+        start = sample["count"]
+        self.path.mkdir(parents=True, exist_ok=True)
+        segment_start = start
+        while segment_start < start + n:
+            # Segments end at multiples of `SEGMENT_SIZE`, or at the last soldier
+            stop = min((segment_start // SEGMENT_SIZE + 1) * SEGMENT_SIZE, start + n)
+            codes, counts = count_combinations(
+                self._roll_segment(sample, segment_start, stop, workers)
+            )
+            # Until the index is updated, it's marked to be rebuilt from the
+            # stored segments, in case that's interrupted
+            sample["indexed"] = None
+            self._save()
+            self._update_index(sample, codes, counts)
+            sample["segments"].append([segment_start, stop])
+            sample["count"] = sample["indexed"] = stop
+            self._save()
+            segment_start = stop
+        return start
+
+    def _roll_segment(self, sample: dict, start: int, stop: int, workers: int):
+        """Roll and store soldiers `start:stop` of `sample`, yielding them a block at a time"""
+        directory = self._directory(sample) / f"{start}-{stop}"
+        directory.mkdir(parents=True, exist_ok=True)
+        columns = {
+            column: np.lib.format.open_memmap(
+                directory / f"{column}.npy",
+                mode="w+",
+                dtype=COLUMN_TYPES[column],
+                shape=(stop - start,),
+            )
+            for column in COLUMNS
+        }
+        # Only whole blocks are rolled, since the soldiers of a block depend
+        # on its size, so the first can start before `start`
+        first_block = start // BLOCK_SIZE * BLOCK_SIZE
+        skip = start - first_block
+        last_block = -(-stop // BLOCK_SIZE) * BLOCK_SIZE
+        position = 0
+        for deltas in iter_deltas(
+            INITIALIZERS[sample["initializer"]],
+            last_block,
+            sample["seed"],
+            workers,
+            first_block,
+            backend=sample["backend"],
+        ):
+            deltas, skip = deltas[skip : skip + stop - start - position], 0
+            rows = slice(position, position + len(deltas))
+            for i, stat in enumerate(STAT_NAMES):
+                columns[stat][rows] = deltas[:, i]
+            columns[TOTAL_COLUMN][rows] = weighed_stat_totals(deltas)
+            position += len(deltas)
+            yield deltas
+        for column in columns.values():
+            column.flush()
+
+    def _read_segment(self, sample: dict, start: int, stop: int):
+        """The stored stat deltas of a segment, a block at a time"""
+        directory = self._directory(sample) / f"{start}-{stop}"
+        columns = [
+            np.load(directory / f"{stat}.npy", mmap_mode="r") for stat in STAT_NAMES
+        ]
+        for block_start in range(0, stop - start, BLOCK_SIZE):
+            rows = slice(block_start, block_start + BLOCK_SIZE)
+            yield np.column_stack([column[rows] for column in columns]).astype(np.int16)
+
+    def _update_index(self, sample: dict, codes: NDArray, counts: NDArray):
+        """Count soldiers with the combinations of `codes` in the index of `sample`"""
+        directory = self._directory(sample) / "index"
+        directory.mkdir(parents=True, exist_ok=True)
+        self._indexes.pop(directory, None)
+        if (directory / "codes.npy").exists():
+            codes, counts = merge_counts(
+                [
+                    (codes, counts),
+                    (
+                        np.load(directory / "codes.npy"),
+                        np.load(directory / "counts.npy"),
+                    ),
+                ]
+            )
+        np.save(directory / "codes.npy", codes)
+        np.save(directory / "counts.npy", counts)
+        for column, values in combination_columns(codes).items():
+            np.save(directory / f"{column}.npy", values)
+            # The combinations of every value of the column, in the order
+            # of the list, so that those of a range of values are together
+            order = np.argsort(values, kind="stable").astype(ORDER_TYPE)
+            np.save(directory / f"{column}-order.npy", order)
+            np.save(directory / f"{column}-offsets.npy", value_offsets(values, column))
+
+    def _reindex(self, sample: dict):
+        """Rebuild the index of `sample` from its stored segments"""
+        directory = self._directory(sample) / "index"
+        self._indexes.pop(directory, None)
+        shutil.rmtree(directory, ignore_errors=True)
+        for start, stop in sample["segments"]:
+            self._update_index(
+                sample, *count_combinations(self._read_segment(sample, start, stop))
+            )
+        sample["indexed"] = sample["count"]
+        self._save()
+
+    def _index(self, sample: dict) -> dict[str, NDArray]:
+        """
+        The index of `sample`, memory-mapped: the columns and counts of
+        its combinations, and their order and offsets by every column
+        """
+        if sample["indexed"] != sample["count"]:
+            self._reindex(sample)
+        directory = self._directory(sample) / "index"
+        if directory not in self._indexes:
+            names = ["counts"] + [
+                f"{column}{suffix}"
+                for column in COLUMNS
+                for suffix in ["", "-order", "-offsets"]
+            ]
+            self._indexes[directory] = {
+                name: np.load(directory / f"{name}.npy", mmap_mode="r")
+                for name in names
+            }
+        return self._indexes[directory]
+
+    def _combinations(self, sample: dict, conditions, grouped=()):
+        """
+        The counts of the combinations of the index of `sample` that can
+        meet every condition, with their columns of `grouped` and the
+        conditions, in chunks of `CHUNK_SIZE`. With conditions, only the
+        combinations in the range of the one that the fewest meet are
+        read, through the order of the index by its column.
+        """
+        index = self._index(sample)
+        needed = list(
+            dict.fromkeys([*grouped, *[column for column, *__ in conditions]])
+        )
+        rows = None
+        for column, lowest, highest in conditions:
+            values = delta_slice(column, lowest, highest)
+            offsets = index[f"{column}-offsets"]
+            start = offsets[values.start]
+            stop = offsets[values.stop] if values.stop > values.start else start
+            if rows is None or stop - start < len(rows):
+                # In the order of the list, which is read front to back
+                rows = np.sort(index[f"{column}-order"][start:stop])
+
+        size = len(index["counts"]) if rows is None else len(rows)
+        for chunk_start in range(0, size, CHUNK_SIZE):
+            chunk = slice(chunk_start, chunk_start + CHUNK_SIZE)
+            selected = chunk if rows is None else rows[chunk]
+            yield {
+                column: np.asarray(index[column][selected]) for column in needed
+            }, np.asarray(index["counts"][selected])
+
+    def _matching(self, sample: dict, conditions, grouped=()):
+        """(group values, count) of the combinations of `sample` that meet every condition"""
+        for columns, counts in self._combinations(sample, conditions, grouped):
+            selected = np.ones(len(counts), dtype=bool)
+            for column, lowest, highest in conditions:
+                selected &= in_range(columns[column], column, lowest, highest)
+            counts = counts[selected]
+            if not grouped:
+                yield (), int(counts.sum())
+                continue
+            values = [columns[column][selected].astype(np.int64) for column in grouped]
+            lowest = [COLUMN_RANGES[column].min_delta for column in grouped]
+            spans = [
+                COLUMN_RANGES[column].max_delta - COLUMN_RANGES[column].min_delta + 1
+                for column in grouped
+            ]
+            codes = np.ravel_multi_index(
+                [value - low for value, low in zip(values, lowest)], spans
+            )
+            sums = np.bincount(codes, counts, np.prod(spans)).astype(np.int64)
+            for code in np.flatnonzero(sums):
+                offsets = np.unravel_index(code, spans)
+                yield tuple(
+                    int(offset) + low for offset, low in zip(offsets, lowest)
+                ), int(sums[code])
+
+    def count(self, conditions=(), by=()) -> dict[tuple, int]:
+        """
+        The number of stored soldiers that meet every condition of
+        `rare.parse_condition`, for every group of values of `by`, which
+        can be "initializer", "seed" and any column. Only groups that have
+        any soldiers are counted. This only reads the indexes.
+        """
+        for key in by:
+            if key not in TAGS and key not in COLUMNS:
+                raise ValueError(f"can't group by {key!r}")
+        grouped = [key for key in by if key in COLUMNS]
+        counts: defaultdict[tuple, int] = defaultdict(int)
+        for sample in self._samples():
+            for values, number in self._matching(sample, conditions, grouped):
+                if number:
+                    # Columns are stored as deltas, but grouped by their values
+                    value = {
+                        column: delta + COLUMN_RANGES[column].default
+                        for column, delta in zip(grouped, values)
+                    }
+                    counts[
+                        tuple(value.get(key, sample.get(key)) for key in by)
+                    ] += number
+        return dict(sorted(counts.items()))
+
+    def fractions(self, conditions=(), by=()) -> dict[tuple, float]:
+        """
+        `count` as shares of all the soldiers stored of the initializer
+        and seed of every group
+        """
+        tags = [key for key in by if key in TAGS]
+        totals = self.count((), tags)
+        return {
+            group: count
+            / totals[tuple(value for key, value in zip(by, group) if key in TAGS)]
+            for group, count in self.count(conditions, by).items()
+        }
+
+    def rows(
+        self, conditions=(), initializer: str | None = None, seed: int | None = None
+    ) -> dict[tuple[str, int], NDArray]:
+        """
+        The indexes of the stored soldiers that meet every condition, in
+        the samples of every (initializer, seed). Unlike `count`, this
+        reads the columns of the conditions, but only of the samples whose
+        index has any such soldiers.
+        """
+        found = {}
+        for sample in self._samples(initializer, seed):
+            if not sum(number for __, number in self._matching(sample, conditions)):
+                continue
+            indexes = []
+            for start, stop in sample["segments"]:
+                directory = self._directory(sample) / f"{start}-{stop}"
+                selected = np.ones(stop - start, dtype=bool)
+                for column, lowest, highest in conditions:
+                    values = np.load(directory / f"{column}.npy", mmap_mode="r")
+                    selected &= in_range(values, column, lowest, highest)
+                indexes.append(start + np.flatnonzero(selected))
+            found[sample["initializer"], sample["seed"]] = np.concatenate(indexes)
+        return found
+
+    def load(self, initializer: str, seed: int, indexes=None) -> SoldierBatch:
+        """The stored soldiers at `indexes` in the sample of `initializer` and `seed`"""
+        sample = self.sample(initializer, seed)
+        if sample is None:
+            raise KeyError(f"no {initializer} soldiers of seed {seed} are stored")
+        if indexes is None:
+            indexes = np.arange(sample["count"])
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if ((indexes < 0) | (indexes >= sample["count"])).any():
+            raise IndexError(f"only {sample['count']} soldiers are stored")
+        batch = SoldierBatch.zeros(len(indexes))
+        for start, stop in sample["segments"]:
+            inside = np.flatnonzero((indexes >= start) & (indexes < stop))
+            if not len(inside):
+                continue
+            directory = self._directory(sample) / f"{start}-{stop}"
+            for i, stat in enumerate(STAT_NAMES):
+                values = np.load(directory / f"{stat}.npy", mmap_mode="r")
+                batch.deltas[inside, i] = values[indexes[inside] - start]
+        return batch
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("python barracks.py")
+    parser.add_argument("path", help="Directory of the barracks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser(
+        "add",
+        help="Roll and store more soldiers; they take 9 bytes each on disk, "
+        f"and their index about {INDEX_BYTES} bytes per distinct combination of "
+        "stats, which is nearly every ANCE soldier",
+    )
+    add.add_argument(
+        "--initializer",
+        choices=INITIALIZERS,
+        help="Which initializer to use",
+        required=True,
+    )
+    add.add_argument(
+        "-n", "--number", type=int, required=True, help="Number of soldiers to add"
+    )
+    add.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the sample, whose stored soldiers the new ones follow",
+    )
+    add.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to roll the soldiers with",
+    )
+    add.add_argument("--backend", default="numpy", help="Backend to roll soldiers with")
+
+    count = commands.add_parser(
+        "count", help="Count the stored soldiers that meet conditions"
+    )
+    count.add_argument(
+        "conditions",
+        nargs="*",
+        metavar="CONDITION",
+        help='Conditions on stats that all have to hold, like "Offense>=70", '
+        f'"Mobility<=13" or "{TOTAL_COLUMN}>=20"',
+    )
+    count.add_argument(
+        "--by",
+        nargs="+",
+        default=["initializer"],
+        help=f"What to count separately: any of {', '.join(TAGS)}, or a stat",
+    )
+    args = parser.parse_args()
+
+    barracks = Barracks(args.path)
+    if args.command == "add":
+        if args.number <= 0:
+            parser.error("-n has to be positive")
+        if args.workers < 1:
+            parser.error("--workers has to be positive")
+        try:
+            start = barracks.add(
+                args.initializer, args.number, args.seed, args.workers, args.backend
+            )
+        except ValueError as error:
+            parser.error(str(error))
+        print(
+            f"Stored {args.initializer} soldiers {start} to "
+            f"{start + args.number - 1} of seed {args.seed}"
+        )
+    else:
+        try:
+            conditions = [
+                parse_condition(condition, COLUMN_RANGES)
+                for condition in args.conditions
+            ]
+            counts = barracks.count(conditions, args.by)
+            fractions = barracks.fractions(conditions, args.by)
+        except ValueError as error:
+            parser.error(str(error))
+        widths = [max(len(key), 11) for key in args.by]
+        print(
+            *(key.ljust(width) for key, width in zip(args.by, widths)),
+            "       count  fraction",
+        )
+        for group, number in counts.items():
+            print(
+                *(str(value).ljust(width) for value, width in zip(group, widths)),
+                f"{number:12d}",
+                f"{fractions[group]:9.3g}",
+            )
@@ -0,0 +1,505 @@
+"""
+Vectorized soldier generation.
+
+Rolls a whole sample of soldiers at once as an (n, 7) array instead of
+building one `Soldier` at a time. The process is the same as in
+`StatSwapper.__call__`: roll the dice for the number of swaps, then for
+each swap try up to 1000 times to find one that keeps every stat in bounds.
+"""
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+from typing import Any, Iterator, Sequence
+
+import numpy as np
+from numpy.typing import NDArray
+
+from soldier import (
+    MAX_TRIES,
+    AliasTable,
+    SamplerProfile,
+    Soldier,
+    StatSwapper,
+    dice_sum_distribution,
+)
+
+DEFAULTS = np.array([range_.default for range_ in Soldier.STATS.values()])
+MIN_DELTAS = np.array([range_.min_delta for range_ in Soldier.STATS.values()])
+MAX_DELTAS = np.array([range_.max_delta for range_ in Soldier.STATS.values()])
+WEIGHTS = np.array([range_.weight for range_ in Soldier.STATS.values()])
+STAT_NAMES = list(Soldier.STATS)
+SPANS = MAX_DELTAS - MIN_DELTAS + 1
+MIN_TOTAL = int(MIN_DELTAS @ WEIGHTS)
+TOTALS_SPAN = int((MAX_DELTAS - MIN_DELTAS) @ WEIGHTS) + 1
+
+# Samples are split into blocks of this many soldiers, each with its own
+# RNG stream, so that the result doesn't depend on how blocks are distributed
+BLOCK_SIZE = 1 << 17
+
+
+def swap_deltas(initializer: StatSwapper) -> tuple[NDArray, NDArray]:
+    """
+    The stat deltas of every swap in the table of `initializer`,
+    followed by the deltas of every flipped swap, along with the
+    probability of drawing each one of them.
+    """
+    compiled = initializer.compile()
+    deltas = np.zeros([len(compiled.swaps), len(Soldier.STATS)], dtype=np.int16)
+    for swap_index, (up, up_amount, down, down_amount) in enumerate(
+        zip(compiled.ups, compiled.up_amounts, compiled.downs, compiled.down_amounts)
+    ):
+        deltas[swap_index, up] += up_amount
+        deltas[swap_index, down] -= down_amount
+
+    weights = np.array(compiled.weights, dtype=float)
+    return deltas, weights / weights.sum()
+
+
+def alias_draws(table: AliasTable, uniforms: NDArray) -> NDArray:
+    """`soldier.alias_draw` of every one of `uniforms`"""
+    probability, alias = np.asarray(table.probability), np.asarray(table.alias)
+    uniforms = uniforms * len(probability)
+    indices = uniforms.astype(np.intp)
+    return np.where(uniforms - indices < probability[indices], indices, alias[indices])
+
+
+def inverse_draws(cumulative: NDArray, uniforms: NDArray) -> NDArray:
+    """
+    The index of every one of `uniforms` into the cumulative sums of
+    some probabilities, so that larger uniforms always draw later indices
+    """
+    indices = np.searchsorted(cumulative, uniforms * cumulative[-1], side="right")
+    return np.minimum(indices, len(cumulative) - 1)
+
+
+def coupling_order(deltas: NDArray) -> NDArray:
+    """
+    The order of the swaps with stat `deltas` that coupled draws go
+    through: grouped by the stat they raise most, in the order of
+    `Soldier.STATS`, then by the stat they lower most, and largest raises
+    first. Similar swaps of different tables so take up similar shares
+    of the uniform numbers, and the same number draws similar swaps.
+    """
+    raised = np.where(deltas.max(1) > 0, deltas.argmax(1), len(STAT_NAMES))
+    lowered = np.where(deltas.min(1) < 0, deltas.argmin(1), -1)
+    return np.lexsort((deltas.min(1), -deltas.max(1), lowered, raised))
+
+
+def generate_deltas(
+    initializer: StatSwapper,
+    n: int,
+    rng: np.random.Generator | None = None,
+    rolls: int | None = None,
+    profile: SamplerProfile | None = None,
+) -> NDArray:
+    """
+    Roll `n` soldiers with `initializer` and return their stat deltas
+    (current value minus default) as an (n, 7) array.
+    With `rolls`, every soldier gets that many swaps instead of rolling the dice.
+    With `profile`, the tries of every roll are counted into it.
+    """
+    rng = np.random.default_rng(rng)
+    sample, __ = roll_soldiers(
+        initializer,
+        n,
+        lambda soldiers, __: rng.random(len(soldiers)),
+        rolls,
+        profile=profile,
+    )
+    return sample
+
+
+def roll_soldiers(
+    initializer: StatSwapper,
+    n: int,
+    uniforms,
+    rolls: int | None = None,
+    record: bool = False,
+    coupled: bool = False,
+    profile: SamplerProfile | None = None,
+) -> tuple[NDArray, NDArray | None]:
+    """
+    The stat deltas of `generate_deltas`, where `uniforms(soldiers, draw)`
+    draws the next uniform number of each of the soldiers at the indices
+    `soldiers`. `draw` numbers the draw within a soldier: 0 for the dice,
+    then `1 + step * MAX_TRIES + attempt` for every try of every swap.
+    With `record`, also the (n, most rolls) array of the index
+    into `compiled.swaps` of the swap applied on every roll of every
+    soldier, -1 where no swap fit and -2 past the soldier's last roll.
+
+    With `coupled`, draws go through the inverse of the cumulative
+    probabilities instead of the alias tables, with the swaps in
+    `coupling_order`, so that different initializers given the same
+    uniform numbers roll similar numbers of swaps and similar swaps.
+    With `profile`, the tries of every roll and the swaps they applied and
+    rejected are counted into it, like in `soldier.SamplerProfile.count`.
+    """
+    started = time.perf_counter()
+    compiled = initializer.compile()
+    sample = np.zeros([n, len(Soldier.STATS)], dtype=np.int16)
+    # The number of swaps of every soldier
+    soldier_rolls: NDArray
+    if rolls is not None:
+        soldier_rolls = np.full(n, rolls)
+    elif coupled:
+        # The sum of the dice, in one draw
+        soldier_rolls = inverse_draws(
+            np.cumsum(dice_sum_distribution(initializer.dice)),
+            uniforms(np.arange(n), 0),
+        )
+    else:
+        soldier_rolls = alias_draws(compiled.rolls, uniforms(np.arange(n), 0))
+    applied: NDArray | None = None
+    if record:
+        applied = np.full([n, soldier_rolls.max(initial=0)], -2, dtype=np.int16)
+    deltas, probabilities = swap_deltas(initializer)
+    # Rolls by number of tries, and tries by swap drawn
+    tries = np.zeros(MAX_TRIES + 1, dtype=np.int64)
+    applied_counts = np.zeros(len(deltas), dtype=np.int64)
+    rejected_counts = np.zeros(len(deltas), dtype=np.int64)
+    exhausted = 0
+    if not n or not soldier_rolls.any():
+        if profile is not None:
+            profile.count(n, tries, applied_counts, rejected_counts, exhausted)
+        return sample, applied
+
+    if coupled:
+        order = coupling_order(deltas)
+        cumulative = np.cumsum(probabilities[order])
+
+        def draw_swaps(uniforms_):
+            return order[inverse_draws(cumulative, uniforms_)]
+
+    else:
+        swap_alias = AliasTable(*map(np.array, compiled.swap_alias))
+
+        def draw_swaps(uniforms_):
+            return alias_draws(swap_alias, uniforms_)
+
+    for step in range(soldier_rolls.max()):
+        pending = np.flatnonzero(soldier_rolls > step)
+        if applied is not None:
+            applied[pending, step] = -1
+        # Only the soldiers whose swap was out of bounds are tried again
+        for attempt in range(MAX_TRIES):
+            drawn = draw_swaps(uniforms(pending, 1 + step * MAX_TRIES + attempt))
+            swapped = sample[pending] + deltas[drawn]
+            valid = ((swapped >= MIN_DELTAS) & (swapped <= MAX_DELTAS)).all(1)
+            sample[pending[valid]] = swapped[valid]
+            if applied is not None:
+                applied[pending[valid], step] = drawn[valid]
+            if profile is not None:
+                tries[attempt + 1] += valid.sum()
+                applied_counts += np.bincount(drawn[valid], minlength=len(deltas))
+                rejected_counts += np.bincount(drawn[~valid], minlength=len(deltas))
+            pending = pending[~valid]
+            if not len(pending):
+                break
+        tries[MAX_TRIES] += len(pending)
+        exhausted += len(pending)
+
+    if profile is not None:
+        profile.count(n, tries, applied_counts, rejected_counts, exhausted)
+        profile.seconds += time.perf_counter() - started
+    return sample, applied
+
+
+def blocks(
+    n: int, seed: int | np.random.SeedSequence | None = None, start: int = 0
+) -> list[tuple[int, int, np.random.SeedSequence]]:
+    """
+    (start, stop, seed) of every block of `BLOCK_SIZE` soldiers in a sample
+    of `n`, where every block gets its own child stream of `seed`.
+    With `start`, which has to be a multiple of `BLOCK_SIZE`,
+    only the blocks from soldier `start` on.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    if start % BLOCK_SIZE:
+        raise ValueError(f"start {start} is not a multiple of {BLOCK_SIZE}")
+    starts = range(start, n, BLOCK_SIZE)
+    stops = [min(block_start + BLOCK_SIZE, n) for block_start in starts]
+    # The same as seed.spawn(), without depending on what was spawned before
+    seeds = [
+        np.random.SeedSequence(
+            seed.entropy,
+            spawn_key=seed.spawn_key + (block_start // BLOCK_SIZE,),
+            pool_size=seed.pool_size,
+        )
+        for block_start in starts
+    ]
+    return list(zip(starts, stops, seeds))
+
+
+def _roll_block(
+    initializer, start, stop, seed, rolls=None, backend="numpy", profile=False
+):
+    """
+    The block's deltas for `iter_blocks`, with its `SamplerProfile` if
+    `profile`, or else None
+    """
+    from backends import get_backend  # Which imports this module
+
+    if profile:
+        block_profile = SamplerProfile(len(initializer.compile().swaps))
+        deltas = generate_deltas(
+            initializer, stop - start, np.random.default_rng(seed), rolls, block_profile
+        )
+        return [deltas], block_profile
+    deltas = get_backend(backend).generate(
+        initializer, stop - start, np.random.default_rng(seed), rolls
+    )
+    return [deltas], None
+
+
+def _shared_block(function, shm_name, shape, offset, start, stop, *args):
+    """
+    Write the deltas of `function(start, stop, *args)` to soldiers
+    `start:stop` of the shared arrays that start at `offset`,
+    and return what else it returned
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        shared = np.ndarray(shape, dtype=np.int16, buffer=shm.buf)
+        arrays, result = function(start, stop, *args)
+        for index, deltas in enumerate(arrays):
+            shared[index, start - offset : stop - offset] = deltas
+        del shared
+    finally:
+        shm.close()
+    return result
+
+
+def iter_blocks(
+    function, ranges: Sequence[tuple], workers: int = 1, arrays: int = 1
+) -> Iterator[tuple[list[NDArray], Any]]:
+    """
+    `function(start, stop, *args)` of every `(start, stop, *args)` in
+    `ranges`, in order, where `function` returns a list of `arrays`
+    (stop - start, 7) int16 arrays of stat deltas and something else to
+    pickle, like a `SamplerProfile`. Blocks are at most `BLOCK_SIZE` long.
+    With `workers`, every block in flight is rolled into a slot of shared
+    arrays, which it's copied out of when it's yielded, instead of being
+    pickled back from the worker.
+    """
+    if workers == 1 or len(ranges) <= 1:
+        for block in ranges:
+            yield function(*block)
+        return
+
+    # At most this many blocks are in flight, one in every slot
+    slots = 2 * workers + 1
+    shape = (arrays, slots * BLOCK_SIZE, len(Soldier.STATS))
+    nbytes = int(np.prod(shape)) * np.dtype(np.int16).itemsize
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    shared = np.ndarray(shape, dtype=np.int16, buffer=shm.buf)
+
+    def finished(pending):
+        offset, (block_start, stop, *__), future = pending.popleft()
+        result = future.result()
+        copies = [
+            deltas[block_start - offset : stop - offset].copy() for deltas in shared
+        ]
+        return copies, result
+
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            pending: deque[tuple[int, tuple, Future]] = deque()
+            for index, block in enumerate(ranges):
+                # The block that used the slot before has been yielded already
+                offset = block[0] - index % slots * BLOCK_SIZE
+                future = pool.submit(
+                    _shared_block, function, shm.name, shape, offset, *block
+                )
+                pending.append((offset, block, future))
+                if len(pending) > 2 * workers:
+                    yield finished(pending)
+            while pending:
+                yield finished(pending)
+    finally:
+        del shared
+        shm.close()
+        shm.unlink()
+
+
+def generate_deltas_parallel(
+    initializer: StatSwapper,
+    n: int,
+    seed: int | np.random.SeedSequence | None = None,
+    workers: int = 1,
+    start: int = 0,
+    backend: str = "numpy",
+) -> NDArray:
+    """
+    Like `generate_deltas`, but split into blocks of `BLOCK_SIZE` soldiers
+    rolled by a pool of `workers` processes into shared memory, by `iter_deltas`.
+    Each block gets a child stream of `seed`, so for a given seed and
+    `backend`, the result is the same for any number of workers.
+    With `start`, only soldiers `start:n` of the sample are rolled.
+    """
+    sample = np.zeros([max(n - start, 0), len(Soldier.STATS)], dtype=np.int16)
+    offset = 0
+    for deltas in iter_deltas(initializer, n, seed, workers, start, backend=backend):
+        sample[offset : offset + len(deltas)] = deltas
+        offset += len(deltas)
+    return sample
+
+
+def iter_deltas(
+    initializer: StatSwapper,
+    n: int,
+    seed: int | np.random.SeedSequence | None = None,
+    workers: int = 1,
+    start: int = 0,
+    rolls: int | None = None,
+    backend: str = "numpy",
+    profile: SamplerProfile | None = None,
+):
+    """
+    The same sample as `generate_deltas_parallel`, but yielded one block
+    at a time, so that only a few blocks are ever in memory at once.
+    With `workers`, the blocks are rolled in shared memory by `iter_blocks`.
+    A sample is the start of the larger samples of its seed only up to its
+    last whole block: a shorter last block is rolled from a stream of its
+    own size, so it differs from the start of the full block.
+    With `rolls`, every soldier gets that many swaps, like in `generate_deltas`.
+    With `profile`, the tries of every block are counted into it, which
+    only the "numpy" backend does.
+    """
+    if profile is not None and backend != "numpy":
+        raise ValueError("only the numpy backend can be profiled")
+    roll = partial(
+        _roll_block,
+        initializer,
+        rolls=rolls,
+        backend=backend,
+        profile=profile is not None,
+    )
+    for (deltas,), block_profile in iter_blocks(roll, blocks(n, seed, start), workers):
+        if profile is not None:
+            profile.merge(block_profile)
+        yield deltas
+
+
+def iter_deltas_to_file(
+    initializer: StatSwapper,
+    n: int,
+    path,
+    seed: int | np.random.SeedSequence | None = None,
+    workers: int = 1,
+    backend: str = "numpy",
+):
+    """
+    Roll the same sample as `iter_deltas` into an (n, 7) int8 .npy file
+    at `path`, through a memory map, yielding every block once it's written.
+    Only the blocks in flight are in memory, so `n` isn't limited by RAM.
+    """
+    output = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.int8, shape=(n, len(Soldier.STATS))
+    )
+    start = 0
+    for deltas in iter_deltas(initializer, n, seed, workers, backend=backend):
+        output[start : start + len(deltas)] = deltas
+        start += len(deltas)
+        yield deltas
+    output.flush()
+    del output
+
+
+def generate_batch(
+    initializer: StatSwapper, n: int, rng: np.random.Generator | None = None
+) -> NDArray:
+    """Roll `n` soldiers with `initializer` and return their stats as an (n, 7) array"""
+    return generate_deltas(initializer, n, rng) + DEFAULTS.astype(np.int16)
+
+
+class SoldierBatch:
+    """
+    Many soldiers stored as one contiguous (n, 7) int8 array of stat deltas,
+    in the order of `Soldier.STATS`. Every delta range fits in an int8,
+    so a soldier takes 7 bytes instead of a `Soldier` and seven `EStat`s.
+    """
+
+    __slots__ = ["deltas"]
+
+    def __init__(self, deltas: NDArray):
+        self.deltas = np.ascontiguousarray(deltas, dtype=np.int8)
+
+    @classmethod
+    def zeros(cls, n: int) -> "SoldierBatch":
+        """`n` soldiers with no stat randomization"""
+        return cls(np.zeros([n, len(Soldier.STATS)], dtype=np.int8))
+
+    @classmethod
+    def generate(
+        cls,
+        initializer: StatSwapper,
+        n: int,
+        seed: int | np.random.SeedSequence | None = None,
+        workers: int = 1,
+        backend: str = "numpy",
+    ) -> "SoldierBatch":
+        """The same soldiers as `generate_deltas_parallel`, filled in block by block"""
+        batch = cls.zeros(n)
+        start = 0
+        for deltas in iter_deltas(initializer, n, seed, workers, backend=backend):
+            batch.deltas[start : start + len(deltas)] = deltas
+            start += len(deltas)
+        return batch
+
+    @classmethod
+    def from_soldiers(cls, soldiers: Sequence[Soldier]) -> "SoldierBatch":
+        batch = cls.zeros(len(soldiers))
+        for index, sol in enumerate(soldiers):
+            batch.deltas[index] = [
+                getattr(sol, stat).current - range_.default
+                for stat, range_ in Soldier.STATS.items()
+            ]
+        return batch
+
+    @classmethod
+    def load(cls, path) -> "SoldierBatch":
+        """
+        Soldiers saved as an int8 .npy file, like by `iter_deltas_to_file`,
+        memory-mapped instead of read into memory
+        """
+        return cls(np.load(path, mmap_mode="r"))
+
+    def __len__(self) -> int:
+        return len(self.deltas)
+
+    def __getitem__(self, index) -> "SoldierBatch":
+        """A view of some of the soldiers, like `sample[index]` on an array"""
+        if isinstance(index, (int, np.integer)):
+            index = slice(index, index + 1 or None)
+        return SoldierBatch(self.deltas[index])
+
+    def stats(self) -> NDArray:
+        """The current stat values as an (n, 7) array"""
+        return self.deltas + DEFAULTS.astype(np.int16)
+
+    def weighed_stat_total(self) -> NDArray:
+        """`Soldier.weighed_stat_total` of every soldier"""
+        return weighed_stat_totals(self.deltas.astype(np.int16))
+
+    def to_dict(self, index: int) -> dict[str, int]:
+        """`Soldier.to_dict` of the soldier at `index`"""
+        # Only the one row, not the whole batch
+        stats = self.deltas[index].astype(np.int16) + DEFAULTS
+        return dict(zip(Soldier.STATS, stats.tolist()))
+
+    def to_soldier(self, index: int) -> Soldier:
+        sol = Soldier()
+        for stat, value in self.to_dict(index).items():
+            getattr(sol, stat).current = value
+        return sol
+
+    def to_soldiers(self) -> list[Soldier]:
+        return [self.to_soldier(index) for index in range(len(self))]
+
+
+def weighed_stat_totals(deltas: NDArray) -> NDArray:
+    """`Soldier.weighed_stat_total` of every row of an (n, 7) array of stat deltas"""
+    return deltas @ WEIGHTS.astype(deltas.dtype)
@@ -0,0 +1,217 @@
+"""
+Benchmarks for soldier generation.
+
+Every case runs in a fresh Python process, so that its peak RSS is its own.
+Results are written as JSON, and can be compared against a saved baseline:
+any case that got slower or bigger by more than the tolerance is reported,
+and the exit status is nonzero.
+
+    python bench.py --output bench.json
+    python bench.py --baseline bench.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent
+INITIALIZER_NAMES = ("lwotc", "ancev1", "ancev2", "ancev3")
+ROLLS = (None, "2d4", "10d8")
+SIZES = (10_000, 100_000, 1_000_000)
+REFERENCE_SIZE = 2_000  # The per-Soldier loop is too slow for the others
+PIPELINE_SIZE = 100_000
+
+
+def cases(sizes=SIZES, pipelines=True):
+    """Every benchmark case, as a JSON-serializable dict"""
+    for initializer in INITIALIZER_NAMES:
+        for rolls in ROLLS:
+            for n in sizes:
+                yield {
+                    "kind": "generate",
+                    "initializer": initializer,
+                    "rolls": rolls,
+                    "n": n,
+                }
+        yield {
+            "kind": "reference",
+            "initializer": initializer,
+            "rolls": None,
+            "n": REFERENCE_SIZE,
+        }
+        if pipelines:
+            yield {
+                "kind": "main",
+                "initializer": initializer,
+                "rolls": None,
+                "n": PIPELINE_SIZE,
+            }
+    if pipelines:
+        yield {
+            "kind": "steam_workshop_images",
+            "initializer": None,
+            "rolls": None,
+            "n": PIPELINE_SIZE,
+        }
+
+
+def case_name(case) -> str:
+    return "/".join(str(case[key]) for key in ("kind", "initializer", "rolls", "n"))
+
+
+def run_case(case):
+    """Run a "generate" or "reference" case in this process and print its timing"""
+    from main import dice_notation, generate_sample
+    from soldier import INITIALIZERS
+
+    initializer = INITIALIZERS[case["initializer"]]
+    if case["rolls"] is not None:
+        initializer.dice = dice_notation(case["rolls"])
+
+    start = time.perf_counter()
+    generate_sample(
+        case["n"], initializer, seed=0, vectorized=case["kind"] == "generate"
+    )
+    seconds = time.perf_counter() - start
+
+    expected_rolls = case["n"] * sum((sides + 1) / 2 for sides in initializer.dice)
+    print(json.dumps({"seconds": seconds, "rolls": expected_rolls}))
+
+
+def measure(case) -> dict:
+    """Run `case` in a new process and measure it"""
+    env = dict(os.environ, PYTHONPATH=str(REPO), MPLBACKEND="Agg")
+    with tempfile.TemporaryDirectory() as cwd:
+        if case["kind"] == "main":
+            command = [REPO / "main.py", "-n", str(case["n"]), "--seed", "0"]
+            command += ["--initializer", case["initializer"], "--statistics"]
+        elif case["kind"] == "steam_workshop_images":
+            (Path(cwd) / "img").mkdir()  # Where the images are written
+            command = [
+                REPO / "steam_workshop_images.py",
+                "-n",
+                str(case["n"]),
+                "--seed",
+                "0",
+            ]
+        else:
+            command = [REPO / "bench.py", "--case", json.dumps(case)]
+
+        with tempfile.TemporaryFile() as output:
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable, *map(str, command)],
+                cwd=cwd,
+                env=env,
+                stdout=output,
+            )
+            # Not process.wait(), which would throw away the resource usage
+            __, status, rusage = os.wait4(process.pid, 0)
+            seconds = time.perf_counter() - start
+            output.seek(0)
+            stdout = output.read()
+        if os.waitstatus_to_exitcode(status):
+            raise RuntimeError(f"Benchmark {case_name(case)} failed")
+
+    result = {"case": case, "peak_rss_kib": rusage.ru_maxrss}
+    if case["kind"] in ("generate", "reference"):
+        timing = json.loads(stdout)
+        seconds = timing["seconds"]
+        result["seconds_per_swap"] = (
+            seconds / timing["rolls"] if timing["rolls"] else None
+        )
+    result["seconds"] = seconds
+    result["soldiers_per_second"] = case["n"] / seconds
+    return result
+
+
+def compare(results, baseline, tolerance: float) -> list[str]:
+    """Descriptions of every case in `results` that regressed from `baseline`"""
+    baseline = {case_name(result["case"]): result for result in baseline}
+    regressions = []
+    for result in results:
+        name = case_name(result["case"])
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if result["seconds"] > old["seconds"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: {old['seconds']:.3f} s -> {result['seconds']:.3f} s"
+            )
+        if result["peak_rss_kib"] > old["peak_rss_kib"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: peak RSS {old['peak_rss_kib']} KiB -> {result['peak_rss_kib']} KiB"
+            )
+    return regressions
+
+
+def main(args):
+    results = []
+    for case in cases(args.sizes, not args.no_pipelines):
+        # The fastest run is the least disturbed by everything else going on
+        result = min(
+            (measure(case) for __ in range(args.repeat)),
+            key=lambda result: result["seconds"],
+        )
+        results.append(result)
+        print(
+            f"{case_name(case):<45} {result['soldiers_per_second']:>12.0f} soldiers/s"
+            f" {result['peak_rss_kib'] / 1024:>8.1f} MiB",
+            flush=True,
+        )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("python bench.py")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument(
+        "--baseline",
+        help="Fail if any case regressed from the results in this JSON file",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown or growth in peak RSS that counts as a regression",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=SIZES,
+        help="Sample sizes to benchmark generation with",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Run every case this many times and keep the fastest run",
+    )
+    parser.add_argument(
+        "--no-pipelines",
+        action="store_true",
+        help="Skip the main.py and steam_workshop_images.py benchmarks",
+    )
+    parser.add_argument("--case", type=json.loads, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args.case)
+    else:
+        main(args)
@@ -0,0 +1,158 @@
+"""
+On-disk cache of generated samples.
+
+Samples are stored as .npy files of int8 stat deltas, named by a hash of
+everything that decides which soldiers get rolled: the dice, the swap
+table, `Soldier.STATS`, the seed, the backend and the block size. Changing
+any of them gives a different name, so entries of an old swap table are
+never read again, and are eventually evicted as least recently used.
+
+The whole blocks of `batch.BLOCK_SIZE` soldiers of a sample are the same
+for any larger sample of the seed, so they are cached in one entry. Asking
+for more soldiers than are cached generates only the missing blocks. A
+shorter last block is rolled from a stream of its own size, so it is
+cached in an entry of the exact number of soldiers. The entries aren't
+compressed, so they are read through a memory map a block at a time, and
+a sample never has to fit in memory.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+from numpy.typing import NDArray
+
+from batch import BLOCK_SIZE, iter_deltas
+from soldier import Soldier, StatSwapper
+
+CACHE_DIR = Path(
+    os.environ.get("SOLDIERSTATS_CACHE", Path.home() / ".cache" / "soldierstats")
+)
+MAX_CACHE_BYTES = 1 << 30
+# Bump when generation changes in a way that isn't in the key
+CACHE_VERSION = 2
+
+
+def cache_key(
+    initializer: StatSwapper,
+    seed: int | np.random.SeedSequence,
+    backend: str = "numpy",
+) -> str:
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    key = {
+        "version": CACHE_VERSION,
+        "block_size": BLOCK_SIZE,
+        "dice": list(initializer.dice),
+        "swap_table": [list(swap) for swap in initializer.swap_table],
+        "stats": {stat: list(range_) for stat, range_ in Soldier.STATS.items()},
+        "seed": [str(seed.entropy), list(seed.spawn_key), seed.pool_size],
+        "backend": backend,
+    }
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def cached_deltas(
+    initializer: StatSwapper,
+    n: int,
+    seed: int | np.random.SeedSequence,
+    workers: int = 1,
+    cache_dir: Path = CACHE_DIR,
+    max_bytes: int = MAX_CACHE_BYTES,
+    backend: str = "numpy",
+) -> Iterator[NDArray]:
+    """
+    The same (n, 7) int16 stat deltas as `batch.iter_deltas`, yielded a
+    block at a time: first the cached blocks, read through a memory map,
+    then the rest, rolled by `batch.iter_deltas` and saved as they come
+    """
+    key = cache_key(initializer, seed, backend)
+    path = Path(cache_dir) / f"{key}.npy"
+    tail_path = Path(cache_dir) / f"{key}.{n}.npy"
+    blocks_end = n // BLOCK_SIZE * BLOCK_SIZE
+
+    entry = open_entry(path)
+    cached = 0 if entry is None else min(len(entry), blocks_end)
+    tail = open_entry(tail_path) if n > blocks_end else None
+    # The blocks the entry doesn't have yet go into a longer entry
+    temporary = temporary_path(path)
+    output = None
+    if blocks_end > cached:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        output = np.lib.format.open_memmap(
+            temporary, mode="w+", dtype=np.int8, shape=(blocks_end, len(Soldier.STATS))
+        )
+    try:
+        if entry is not None:
+            for start in range(0, cached, BLOCK_SIZE):
+                deltas = entry[start : start + BLOCK_SIZE]
+                if output is not None:
+                    output[start : start + len(deltas)] = deltas
+                yield deltas.astype(np.int16)
+            del entry
+
+        stop = n if tail is None else blocks_end
+        new_deltas = iter_deltas(
+            initializer, stop, seed, workers, cached, backend=backend
+        )
+        for start, deltas in zip(range(cached, stop, BLOCK_SIZE), new_deltas):
+            if start >= blocks_end:
+                write_entry(tail_path, deltas)
+            elif output is not None:
+                output[start : start + len(deltas)] = deltas
+            yield deltas
+        if tail is not None:
+            yield tail.astype(np.int16)
+
+        if output is not None:
+            output.flush()
+            del output
+            os.replace(temporary, path)
+    finally:
+        # Only left behind if the sample wasn't read to the end
+        temporary.unlink(missing_ok=True)
+    if blocks_end > cached or (n > blocks_end and tail is None):
+        evict(cache_dir, max_bytes)
+
+
+def open_entry(path: Path) -> NDArray | None:
+    """
+    The int8 stat deltas of the entry at `path`, memory-mapped so that only
+    the rows that are used are read, or None if there is no such entry
+    """
+    try:
+        entry = np.load(path, mmap_mode="r")
+    except FileNotFoundError:
+        return None
+    os.utime(path)  # Mark as recently used
+    return entry
+
+
+def temporary_path(path: Path) -> Path:
+    """Where an entry is written first, so that readers never see half a file"""
+    return path.with_suffix(f".{os.getpid()}.tmp.npy")
+
+
+def write_entry(path: Path, deltas: NDArray):
+    """Save `deltas` as an int8 entry at `path`"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = temporary_path(path)
+    np.save(temporary, deltas.astype(np.int8))
+    os.replace(temporary, path)
+
+
+def evict(cache_dir: Path = CACHE_DIR, max_bytes: int = MAX_CACHE_BYTES):
+    """Remove the least recently used entries until the cache fits in `max_bytes`"""
+    entries = sorted(
+        (entry.stat().st_mtime, entry.stat().st_size, entry)
+        for entry in Path(cache_dir).glob("*.npy")
+        if ".tmp." not in entry.name
+    )
+    size = sum(entry_size for __, entry_size, entry in entries)
+    for __, entry_size, entry in entries:
+        if size <= max_bytes:
+            break
+        entry.unlink(missing_ok=True)
+        size -= entry_size
@@ -0,0 +1,123 @@
+"""
+Soldiers rolled with a counter-based random number generator.
+
+Instead of taking the next number of one sequential stream, random number
+`j` of soldier `i` is Philox4x32-10 of the counter (j, i), keyed by the
+seed. Every soldier so only depends on the seed and its own index: soldier
+`i` of a sample can be rolled again on its own, and any range of soldiers
+rolled by itself, in any process and order, is the same as that range of
+the whole sample.
+
+These are other soldiers than those of `batch.generate_deltas_parallel`
+for the same seed.
+"""
+from functools import partial
+
+import numpy as np
+from numpy.typing import NDArray
+
+from batch import BLOCK_SIZE, iter_blocks, roll_soldiers
+from soldier import StatSwap, StatSwapper
+
+PHILOX_MULTIPLIERS = (np.uint64(0xD2511F53), np.uint64(0xCD9E8D57))
+PHILOX_WEYL = (np.uint64(0x9E3779B9), np.uint64(0xBB67AE85))
+PHILOX_ROUNDS = 10
+MASK_32 = np.uint64(0xFFFFFFFF)
+
+
+def philox(counter, key) -> tuple[NDArray, ...]:
+    """
+    Philox4x32-10 of a counter of four arrays of 32-bit words,
+    with a key of two 32-bit words, as four uint64 arrays of 32-bit words
+    """
+    c0, c1, c2, c3 = (np.asarray(word, dtype=np.uint64) for word in counter)
+    k0, k1 = (np.uint64(word) for word in key)
+    for __ in range(PHILOX_ROUNDS):
+        # Products of two 32-bit words fit in 64 bits
+        product_0 = PHILOX_MULTIPLIERS[0] * c0
+        product_1 = PHILOX_MULTIPLIERS[1] * c2
+        c0, c1, c2, c3 = (
+            (product_1 >> np.uint64(32)) ^ c1 ^ k0,
+            product_1 & MASK_32,
+            (product_0 >> np.uint64(32)) ^ c3 ^ k1,
+            product_0 & MASK_32,
+        )
+        k0 = (k0 + PHILOX_WEYL[0]) & MASK_32
+        k1 = (k1 + PHILOX_WEYL[1]) & MASK_32
+    return c0, c1, c2, c3
+
+
+def counter_key(seed: int | np.random.SeedSequence) -> tuple[int, int]:
+    """The Philox key of `seed`"""
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    key = seed.generate_state(2, np.uint32)
+    return int(key[0]), int(key[1])
+
+
+def counter_uniforms(key, indices: NDArray, draws: NDArray) -> NDArray:
+    """Uniform number `draws` of every soldier `indices`, in [0, 1)"""
+    indices = np.asarray(indices, dtype=np.uint64)
+    high, low, __, __ = philox(
+        (draws, indices & MASK_32, indices >> np.uint64(32), np.zeros_like(indices)),
+        key,
+    )
+    # 53 random bits, like `np.random.Generator.random`
+    return ((high >> np.uint64(5)) * 67108864.0 + (low >> np.uint64(6))) / 2.0**53
+
+
+def counter_deltas(
+    initializer: StatSwapper,
+    start: int,
+    stop: int,
+    seed: int | np.random.SeedSequence,
+    record: bool = False,
+) -> tuple[NDArray, NDArray | None]:
+    """
+    The stat deltas of soldiers `start:stop` of the counter-based sample
+    of `seed`, and with `record`, the swaps they got, like `batch.roll_soldiers`
+    """
+    key = counter_key(seed)
+    indices = np.arange(start, stop, dtype=np.uint64)
+    draws = np.zeros(len(indices), dtype=np.uint64)
+
+    def uniforms(soldiers, __):
+        drawn = counter_uniforms(key, indices[soldiers], draws[soldiers])
+        draws[soldiers] += np.uint64(1)
+        return drawn
+
+    return roll_soldiers(initializer, len(indices), uniforms, record=record)
+
+
+def _counter_block(initializer, start, stop, seed):
+    return [counter_deltas(initializer, start, stop, seed)[0]], None
+
+
+def iter_counter_deltas(
+    initializer: StatSwapper,
+    n: int,
+    seed: int | np.random.SeedSequence,
+    workers: int = 1,
+    start: int = 0,
+):
+    """
+    Soldiers `start:n` of the counter-based sample of `seed`, yielded a
+    block of `BLOCK_SIZE` at a time. `start` can be any index, so an
+    interrupted run can be resumed from the last soldier it got to.
+    """
+    ranges = [
+        (block_start, min(block_start + BLOCK_SIZE, n), seed)
+        for block_start in range(start, n, BLOCK_SIZE)
+    ]
+    roll = partial(_counter_block, initializer)
+    for (deltas,), __ in iter_blocks(roll, ranges, workers):
+        yield deltas
+
+
+def describe_swap(swap: StatSwap) -> str:
+    """A swap as the stat changes it makes, like "Offense +4, HP -1" """
+    if swap.StatUp == swap.StatDown:
+        return f"{swap.StatUp} {swap.StatUp_Amount - swap.StatDown_Amount:+d}"
+    return (
+        f"{swap.StatUp} +{swap.StatUp_Amount}, {swap.StatDown} -{swap.StatDown_Amount}"
+    )
@@ -0,0 +1,451 @@
+"""
+Exact distribution of the stats rolled by a `StatSwapper`.
+
+Instead of sampling soldiers, this works out the probability of every
+outcome. The swap process is a Markov chain over the stat deltas: every
+roll applies one swap, drawn with probability proportional to its weight
+among the swaps that stay in bounds, unless all 1000 tries fail. The
+distribution of the number of rolls is the distribution of the dice sum.
+
+There are two engines:
+
+* Tables that move several stats at once (like `LWOTC_SWAPS`) are
+  followed roll by roll over every reachable combination of stat deltas.
+  Only the reachable states are stored, as a sorted array of state codes.
+* Tables where every swap moves a single stat (like `ANCEV3_SWAPS`) have
+  far too many reachable states for that, but there the stats only
+  interact through which stat gets drawn. Spreading the tries out in
+  continuous time makes every stat evolve independently, and the exact
+  distribution is an integral over time of a product of per-stat
+  distributions, which is integrated with Gauss-Legendre quadrature.
+  The 1000-try limit is dropped here, which is only done when running
+  out of tries is less likely than float64 can represent.
+"""
+from itertools import combinations
+
+import numpy as np
+from numpy.polynomial.legendre import leggauss
+from numpy.typing import NDArray
+from scipy import special, stats
+
+from batch import (
+    MAX_DELTAS,
+    MIN_DELTAS,
+    MIN_TOTAL,
+    SPANS,
+    STAT_NAMES,
+    TOTALS_SPAN,
+    WEIGHTS,
+    swap_deltas,
+)
+from soldier import MAX_TRIES, Soldier, StatSwapper, dice_sum_distribution
+
+RADIX = np.cumprod(np.concatenate([[1], SPANS[:-1]]))
+
+# Probability mass below which the factorized engine truncates
+TOLERANCE = 1e-20
+QUADRATURE_DEGREE = 16
+# Weighed stat totals are convolved in two halves, small factors first
+TOTALS_HALVES = (
+    ("HP", "Mobility", "Offense"),
+    ("Hacking", "Will", "Dodge", "PsiOffense"),
+)
+
+
+class ExactDistribution:
+    """
+    The exact distribution of the soldiers rolled by an initializer.
+    Every distribution is indexed by stat delta minus `min_delta`,
+    which is the same as stat value minus its smallest possible value.
+    """
+
+    def __init__(self, marginals, joints, totals):
+        self.marginals: dict[str, NDArray] = marginals
+        self.joints: dict[tuple[str, str], NDArray] = joints
+        self.totals: NDArray = totals  # Indexed by weighed stat total minus MIN_TOTAL
+
+    def values(self, stat: str) -> range:
+        """The stat values the marginal distribution of `stat` is indexed by"""
+        range_ = Soldier.STATS[stat]
+        return range(
+            range_.default + range_.min_delta, range_.default + range_.max_delta + 1
+        )
+
+    def joint(self, stat_1: str, stat_2: str) -> NDArray:
+        """The joint distribution of two stats, indexed by [stat_1, stat_2]"""
+        if (stat_1, stat_2) in self.joints:
+            return self.joints[stat_1, stat_2]
+        return self.joints[stat_2, stat_1].T
+
+    def columns(self, totals=False) -> list[tuple[NDArray, NDArray]]:
+        """
+        (values, probabilities) of every stat, in the same order as the
+        columns of `main.generate_sample`, optionally with weighed stat totals
+        """
+        columns = [
+            (np.array(self.values(stat)), self.marginals[stat]) for stat in STAT_NAMES
+        ]
+        if totals:
+            columns.append((np.arange(TOTALS_SPAN) + MIN_TOTAL, self.totals))
+        return columns
+
+    def mean(self, totals=False) -> NDArray:
+        return np.array([probs @ values for values, probs in self.columns(totals)])
+
+    def moment(self, order: int, totals=False) -> NDArray:
+        """Central moments of every stat"""
+        return np.array(
+            [
+                probs @ (values - mean) ** order
+                for (values, probs), mean in zip(
+                    self.columns(totals), self.mean(totals)
+                )
+            ]
+        )
+
+    def variance(self, totals=False) -> NDArray:
+        return self.moment(2, totals)
+
+    def skewness(self, totals=False) -> NDArray:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.moment(3, totals) / self.moment(2, totals) ** 1.5
+
+    def covariance(self) -> NDArray:
+        cov = np.diag(self.variance())
+        mean = self.mean()
+        for (i, stat_1), (j, stat_2) in combinations(enumerate(STAT_NAMES), 2):
+            centered_1 = np.array(self.values(stat_1)) - mean[i]
+            centered_2 = np.array(self.values(stat_2)) - mean[j]
+            cov[i, j] = cov[j, i] = centered_1 @ self.joint(stat_1, stat_2) @ centered_2
+        return cov
+
+    def correlation(self) -> NDArray:
+        cov = self.covariance()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return cov / np.sqrt(np.outer(cov.diagonal(), cov.diagonal()))
+
+
+def dice_distribution(dice) -> NDArray:
+    """Distribution of the sum of `dice`, indexed by the sum"""
+    return np.array(dice_sum_distribution(dice))
+
+
+def exact_distribution(initializer: StatSwapper) -> ExactDistribution:
+    """The exact distribution of the soldiers rolled by `initializer`"""
+    deltas, probabilities = swap_deltas(initializer)
+    rolls = dice_distribution(initializer.dice)
+    if len(rolls) > 1 and _is_separable(deltas):
+        distribution = _factorized_distribution(deltas, probabilities, rolls)
+        if distribution is not None:
+            return distribution
+    return _chain_distribution(deltas, probabilities, rolls)
+
+
+def _is_separable(deltas: NDArray) -> bool:
+    return bool((np.count_nonzero(deltas, axis=1) <= 1).all())
+
+
+def _chain_distribution(deltas, probabilities, rolls) -> ExactDistribution:
+    """Follow the Markov chain over every reachable combination of stat deltas"""
+    codes = _reachable_codes(deltas, len(rolls) - 1)
+    states = np.asfortranarray(_decode(codes))
+    probability = np.zeros(len(codes))
+    probability[np.searchsorted(codes, -MIN_DELTAS @ RADIX)] = 1.0
+
+    # Chance of applying any swap, and of running out of tries, in every state
+    valid_probability = np.zeros(len(codes))
+    for delta, swap_probability in zip(deltas, probabilities):
+        valid_probability += _in_bounds(states, delta) * swap_probability
+    failure = (1 - valid_probability) ** MAX_TRIES
+    applied = np.divide(
+        1 - failure,
+        valid_probability,
+        out=np.zeros(len(codes)),
+        where=valid_probability > 0,
+    )
+
+    # A swap from a reachable state to a reachable state, and its flip back
+    half = len(deltas) // 2
+    moves = []
+    for delta, swap_probability in zip(deltas[:half], probabilities[:half]):
+        target = codes + delta @ RADIX
+        found = np.searchsorted(codes, target).clip(max=len(codes) - 1)
+        source = np.flatnonzero(_in_bounds(states, delta) & (codes[found] == target))
+        moves.append((source, found[source], swap_probability))
+
+    result = rolls[0] * probability
+    for roll_probability in rolls[1:]:
+        leaving = probability * applied
+        probability = probability * failure
+        for source, target, swap_probability in moves:
+            probability += swap_probability * np.bincount(
+                target, leaving[source], minlength=len(codes)
+            )
+            probability[source] += swap_probability * leaving[target]
+        result += roll_probability * probability
+
+    offsets = states - MIN_DELTAS
+    marginals = {
+        stat: np.bincount(offsets[:, i], result, minlength=SPANS[i])
+        for i, stat in enumerate(STAT_NAMES)
+    }
+    joints = {
+        (stat_1, stat_2): np.bincount(
+            offsets[:, i] * SPANS[j] + offsets[:, j],
+            result,
+            minlength=SPANS[i] * SPANS[j],
+        ).reshape(SPANS[i], SPANS[j])
+        for (i, stat_1), (j, stat_2) in combinations(enumerate(STAT_NAMES), 2)
+    }
+    totals = np.bincount(states @ WEIGHTS - MIN_TOTAL, result, minlength=TOTALS_SPAN)
+    return ExactDistribution(marginals, joints, totals)
+
+
+def _in_bounds(states: NDArray, delta: NDArray) -> NDArray:
+    """Whether applying `delta` keeps each state in bounds"""
+    valid = np.ones(len(states), dtype=bool)
+    for i in np.flatnonzero(delta):
+        swapped = states[:, i] + delta[i]
+        valid &= (swapped >= MIN_DELTAS[i]) & (swapped <= MAX_DELTAS[i])
+    return valid
+
+
+def _reachable_codes(deltas: NDArray, max_rolls: int) -> NDArray:
+    """Sorted codes of every state reachable in at most `max_rolls` swaps"""
+    codes = frontier = np.array([-MIN_DELTAS @ RADIX])
+    for __ in range(max_rolls):
+        reached = []
+        # Chunked, so that the candidates fit in memory
+        for chunk in np.array_split(frontier, len(frontier) // 2**16 + 1):
+            states = _decode(chunk)
+            swapped = states[:, None, :] + deltas
+            valid = ((swapped >= MIN_DELTAS) & (swapped <= MAX_DELTAS)).all(2)
+            reached.append(_sorted_unique((chunk[:, None] + deltas @ RADIX)[valid]))
+        frontier = _sorted_unique(np.concatenate(reached))
+        found = np.searchsorted(codes, frontier).clip(max=len(codes) - 1)
+        frontier = frontier[codes[found] != frontier]
+        if not len(frontier):
+            break
+        codes = np.sort(np.concatenate([codes, frontier]))
+    return codes
+
+
+def _decode(codes: NDArray) -> NDArray:
+    """The stat deltas of every state code"""
+    return ((codes[:, None] // RADIX) % SPANS + MIN_DELTAS).astype(np.int8)
+
+
+def _sorted_unique(codes: NDArray) -> NDArray:
+    # Sorting beats the hash table `np.unique` uses for arrays this big
+    codes = np.sort(codes)
+    return codes[np.concatenate([[True], codes[1:] != codes[:-1]])]
+
+
+def _factorized_distribution(deltas, probabilities, rolls) -> ExactDistribution | None:
+    """
+    Distribution of a table where every swap moves a single stat.
+
+    Tries happen at the times of a rate 1 Poisson process, so that tries
+    that land on each stat form independent Poisson processes. Once K
+    swaps have been applied, the state stays the same until the next
+    successful try, which takes 1 / (chance of success) tries on average.
+    So, for the final state x after K rolls,
+
+        P(x) = success(x) * integral over u of P(K successes, state x at time u)
+
+    and success(x) is a sum over stats, so the integrand is a sum of
+    products of per-stat distributions. Those are carried around as
+    "dual numbers" (value, value with one factor weighed by success)
+    convolved over the number of successes.
+    """
+    max_rolls = len(rolls) - 1
+    # Swaps that move nothing always succeed, so any stat can have them
+    stat_of = np.abs(deltas).argmax(1)
+    rates = np.bincount(stat_of, probabilities, minlength=len(STAT_NAMES))
+
+    # Per-stat attempt chains
+    chains = []
+    min_success = 0.0
+    for i in range(len(STAT_NAMES)):
+        moves = [
+            (delta[i], probability / rates[i])
+            for delta, probability, stat in zip(deltas, probabilities, stat_of)
+            if stat == i
+        ]
+        values = np.arange(MIN_DELTAS[i], MAX_DELTAS[i] + 1)
+        success = np.zeros(SPANS[i])
+        for delta, probability in moves:
+            success += probability * (
+                (values + delta >= MIN_DELTAS[i]) & (values + delta <= MAX_DELTAS[i])
+            )
+        min_success += rates[i] * success.min()
+        chains.append((moves, success))
+    if min_success <= 0 or (1 - min_success) ** MAX_TRIES > TOLERANCE:
+        return None
+
+    # Past `horizon`, fewer than `max_rolls` successes are negligible
+    horizon = special.gammainccinv(max_rolls + 1, TOLERANCE) / min_success
+    nodes, node_weights = _quadrature(float(horizon))
+
+    factors = []
+    for i, (moves, success) in enumerate(chains):
+        if not rates[i]:
+            value = np.zeros([len(nodes), max_rolls + 1, SPANS[i]])
+            value[:, 0, -MIN_DELTAS[i]] = 1
+            factors.append((value, np.zeros_like(value)))
+            continue
+        max_tries = _poisson_quantile(rates[i] * horizon)
+        attempts = _attempt_distributions(moves, success, i, max_tries, max_rolls)
+        poisson = stats.poisson.pmf(np.arange(max_tries + 1), rates[i] * nodes[:, None])
+        value = np.tensordot(poisson, attempts, axes=1)
+        factors.append((value, value * (rates[i] * success)))
+
+    def product(indices):
+        """Dual product over the number of successes of the marginalized stats"""
+        result = np.zeros([len(nodes), max_rolls + 1])
+        result[:, 0] = 1
+        result = (result, np.zeros_like(result))
+        for i in indices:
+            value, weighed = factors[i]
+            result = _dual_multiply(result, (value.sum(2), weighed.sum(2)))
+        return result
+
+    def weights(rest):
+        """For every number of successes, the weight of the remaining stats"""
+        return tuple(_correlate(rolls, part) for part in rest)
+
+    marginals = {}
+    for i, stat in enumerate(STAT_NAMES):
+        rest = weights(product(j for j in range(len(STAT_NAMES)) if j != i))
+        value, weighed = factors[i]
+        marginals[stat] = node_weights @ (
+            np.einsum("ncv,nc->nv", weighed, rest[0])
+            + np.einsum("ncv,nc->nv", value, rest[1])
+        )
+
+    joints = {}
+    for (i, stat_1), (j, stat_2) in combinations(enumerate(STAT_NAMES), 2):
+        rest = weights(product(k for k in range(len(STAT_NAMES)) if k not in (i, j)))
+        value_1, weighed_1 = factors[i]
+        value_2, weighed_2 = factors[j]
+        hankel = [_hankel(part) for part in rest]
+        joints[stat_1, stat_2] = (
+            _contract(weighed_1, hankel[0], value_2, node_weights)
+            + _contract(value_1, hankel[0], weighed_2, node_weights)
+            + _contract(value_1, hankel[1], value_2, node_weights)
+        )
+
+    # Weighed stat totals, from two halves that are combined at the end
+    halves = []
+    for half in TOTALS_HALVES:
+        start = np.zeros([len(nodes), max_rolls + 1, 1])
+        start[:, 0, 0] = 1
+        result = (start, np.zeros_like(start))
+        for i in map(STAT_NAMES.index, half):
+            result = _dual_multiply_totals(result, factors[i], WEIGHTS[i])
+        halves.append(result)
+    (value_1, weighed_1), (value_2, weighed_2) = halves
+    rolls_hankel = _hankel(np.broadcast_to(rolls, (len(nodes), max_rolls + 1)))
+    totals = np.zeros(TOTALS_SPAN)
+    for first, second in ((weighed_1, value_2), (value_1, weighed_2)):
+        combined = _contract(first, rolls_hankel, second, node_weights)
+        for offset, row in enumerate(combined):
+            totals[offset : offset + len(row)] += row
+
+    return ExactDistribution(
+        {stat: marginal.clip(0) for stat, marginal in marginals.items()},
+        {pair: joint.clip(0) for pair, joint in joints.items()},
+        totals.clip(0),
+    )
+
+
+def _poisson_quantile(mean: float) -> int:
+    """The smallest count a Poisson variable exceeds with negligible probability"""
+    counts = np.arange(int(mean + 20 * np.sqrt(mean) + 100))
+    return int(counts[np.argmax(special.pdtrc(counts, mean) < TOLERANCE)])
+
+
+def _quadrature(horizon: float) -> tuple[NDArray, NDArray]:
+    """Composite Gauss-Legendre nodes and weights over [0, horizon]"""
+    # The integrand gets wider over time, about as fast as a square root
+    bounds = [0.0]
+    while bounds[-1] < horizon:
+        bounds.append(bounds[-1] + max(8.0, 4 * np.sqrt(bounds[-1])))
+    edges = np.array(bounds)
+    points, weights = leggauss(QUADRATURE_DEGREE)
+    widths = np.diff(edges)
+    nodes = edges[:-1, None] + (points + 1) / 2 * widths[:, None]
+    return nodes.ravel(), (weights * widths[:, None] / 2).ravel()
+
+
+def _attempt_distributions(moves, success, stat_index, max_tries, max_rolls):
+    """
+    Distributions of (successes, stat delta) of one stat after every
+    number of tries on that stat, indexed by [tries, successes, delta].
+    """
+    span = SPANS[stat_index]
+    distribution = np.zeros([max_rolls + 1, span])
+    distribution[0, -MIN_DELTAS[stat_index]] = 1
+    result = np.zeros([max_tries + 1, max_rolls + 1, span])
+    result[0] = distribution
+    for tries in range(1, max_tries + 1):
+        swapped = distribution * (1 - success)
+        for delta, probability in moves:
+            source = slice(max(0, -delta), span - max(0, delta))
+            target = slice(max(0, delta), span - max(0, -delta))
+            swapped[1:, target] += probability * distribution[:-1, source]
+        distribution = result[tries] = swapped
+    return result
+
+
+def _toeplitz(part: NDArray) -> NDArray:
+    """Matrices that convolve over the number of successes, one per node"""
+    size = part.shape[1]
+    offsets = np.subtract.outer(np.arange(size), np.arange(size))
+    return np.where(offsets >= 0, part[:, offsets.clip(0)], 0)
+
+
+def _hankel(part: NDArray) -> NDArray:
+    """Matrices of `part` indexed by the sum of two numbers of successes"""
+    size = part.shape[1]
+    sums = np.add.outer(np.arange(size), np.arange(size))
+    return np.where(sums < size, part[:, sums.clip(max=size - 1)], 0)
+
+
+def _dual_multiply(first, second):
+    value_1, weighed_1 = first
+    value_2, weighed_2 = second
+    convolve_2 = _toeplitz(value_2)
+    return (
+        np.einsum("nab,nb->na", convolve_2, value_1),
+        np.einsum("nab,nb->na", convolve_2, weighed_1)
+        + np.einsum("nab,nb->na", _toeplitz(weighed_2), value_1),
+    )
+
+
+def _dual_multiply_totals(first, second, weight):
+    """Dual product of distributions over (successes, weighed stat total)"""
+    value_1, weighed_1 = first
+    value_2, weighed_2 = second
+    span = value_1.shape[2] + weight * (value_2.shape[2] - 1)
+    value = np.zeros(value_1.shape[:2] + (span,))
+    weighed = np.zeros_like(value)
+    for delta in range(value_2.shape[2]):
+        convolve_value = _toeplitz(value_2[:, :, delta])
+        convolve_weighed = _toeplitz(weighed_2[:, :, delta])
+        target = slice(weight * delta, weight * delta + value_1.shape[2])
+        value[:, :, target] += convolve_value @ value_1
+        weighed[:, :, target] += convolve_value @ weighed_1 + convolve_weighed @ value_1
+    return value, weighed
+
+
+def _contract(first, hankel, second, node_weights) -> NDArray:
+    """The sum over nodes and successes of weighed first[a] * hankel[a, b] * second[b]"""
+    left = node_weights[:, None, None] * (first.transpose(0, 2, 1) @ hankel)
+    left = left.transpose(1, 0, 2).reshape(left.shape[1], -1)
+    return left @ second.reshape(-1, second.shape[2])
+
+
+def _correlate(rolls: NDArray, part: NDArray) -> NDArray:
+    """For every c, the sum over K of P(K rolls) * part[K - c]"""
+    return np.einsum("ab,nb->na", _hankel(rolls[None])[0], part)
@@ -1,11 +1,35 @@
 import argparse
-from typing import Tuple
+import csv
+import json
+import math
+import random
+import sys
+import time
+from typing import Any, Tuple
 
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy
 
-from soldier import Soldier, INITIALIZERS
+from accumulator import (
+    StatisticsAccumulator,
+    accumulate,
+    array_statistics,
+    precise_statistics,
+    sample_statistics,
+)
+from backends import BACKENDS, get_backend
+from batch import (
+    BLOCK_SIZE,
+    DEFAULTS,
+    SoldierBatch,
+    generate_deltas_parallel,
+    iter_deltas,
+    iter_deltas_to_file,
+    weighed_stat_totals,
+)
+from cache import cached_deltas
+from counter import counter_deltas, describe_swap, iter_counter_deltas
+from soldier import SamplerProfile, Soldier, INITIALIZERS
+from stratified import ALLOCATIONS, stratified_statistics
 
 
 def dice_notation(shorthand: str) -> Tuple[int, int]:
@@ -16,9 +40,46 @@ def dice_notation(shorthand: str) -> Tuple[int, int]:
     return int(left) * (int(right),)
 
 
-def generate_sample(n, initializer, totals=False):
-    """Generate a sample of `n` soldiers initialized with `initializer`"""
+def generate_sample(
+    n,
+    initializer,
+    totals=False,
+    vectorized=True,
+    seed=None,
+    workers=1,
+    cache=False,
+    backend="numpy",
+):
+    """
+    Generate a sample of `n` soldiers initialized with `initializer`.
+    By default, the sample is rolled in blocks with
+    `batch.generate_deltas_parallel` by `backend` on `workers` processes;
+    pass `vectorized=False` to build one `Soldier` at a time in this process.
+    The same `seed` gives the same sample regardless of `workers`.
+    With `cache` and a `seed`, the sample is read from and saved to the cache.
+    """
+    if vectorized and cache and seed is not None:
+        deltas = np.zeros([n, len(Soldier.STATS)], dtype=np.int16)
+        offset = 0
+        for block in cached_deltas(initializer, n, seed, workers, backend=backend):
+            deltas[offset : offset + len(block)] = block
+            offset += len(block)
+    elif vectorized:
+        deltas = generate_deltas_parallel(
+            initializer, n, seed, workers, backend=backend
+        )
+    if vectorized:
+        sample = deltas + DEFAULTS.astype(np.int16)
+        if totals:
+            sample = np.column_stack([sample, weighed_stat_totals(deltas)])
+        return sample
+
     sample = np.zeros([n, len(Soldier.STATS) + bool(totals)], dtype=np.int16)
+    if isinstance(seed, np.random.SeedSequence):
+        # `random.seed` only takes plain values
+        seed = int(seed.generate_state(1)[0])
+    if seed is not None:
+        random.seed(seed)
 
     for i in range(n):
         sol = Soldier(initializer)
@@ -32,51 +93,322 @@ def generate_sample(n, initializer, totals=False):
     return sample
 
 
-def main(args):
-    initializer = INITIALIZERS[args.initializer]
-    if args.rolls is not None:
-        initializer.dice = args.rolls
+def write_statistics(distribution, args, file):
+    """Write the mean, variance and skewness of every stat to `file` as `args.format`"""
+    names = list(Soldier.STATS) + ["WeighedStatTotal"] * args.totals
+    columns = {
+        "mean": distribution.mean(args.totals),
+        "variance": distribution.variance(args.totals),
+        "skewness": distribution.skewness(args.totals),
+    }
+    if args.format == "text":
+        print("Mean:", columns["mean"], file=file)
+        print("Variance:", columns["variance"], file=file)
+        print("Skewness:", columns["skewness"], file=file)
+        return
 
-    sample = generate_sample(args.number, initializer, args.totals)
+    # Only the machine-readable formats have room for the errors
+    if not args.exact:
+        columns["standard_error"] = distribution.standard_errors(args.totals)
 
-    if args.statistics:
-        mean = sample.mean(0)
-        cov = np.diag(np.cov(sample.T))
-        skew = scipy.stats.skew(sample)
-        print("Mean:", mean)
-        print("Variance:", cov)
-        print("Skewness:", skew)
+    rows = {
+        name: {
+            # NaN for stats that never change, which JSON doesn't have
+            key: None if math.isnan(values[i]) else float(values[i])
+            for key, values in columns.items()
+        }
+        for i, name in enumerate(names)
+    }
+    if args.format == "json":
+        json.dump(
+            {
+                "initializer": args.initializer,
+                "exact": args.exact,
+                "n": None if args.exact else distribution.count,
+                "stats": rows,
+            },
+            file,
+            indent=2,
+        )
+        file.write("\n")
+    else:
+        writer = csv.writer(file)
+        writer.writerow(["stat", *columns])
+        for name, row in rows.items():
+            writer.writerow([name, *row.values()])
 
-    if args.plt_show:
-        fig, axs = plt.subplots(4, 2)
-        for stat_index, (stat, range_) in enumerate(Soldier.STATS.items()):
-            values = range(
-                range_.default + range_.min_delta, range_.default + range_.max_delta + 1
-            )
 
-            ax = axs[stat_index // 2, stat_index % 2]
-            ax.set_title(stat)
+def plot_columns(columns, totals=False):
+    """
+    A 4x2 figure of a bar chart of the (values, counts) of every stat in
+    `columns`, and optionally a histogram of the weighed stat totals.
+    Returns the figure, its axes and the bars of every stat.
+    """
+    import matplotlib.pyplot as plt
+
+    fig, axs = plt.subplots(4, 2)
+    bars = []
+    for stat_index, (stat, range_) in enumerate(Soldier.STATS.items()):
+        values = range(
+            range_.default + range_.min_delta, range_.default + range_.max_delta + 1
+        )
+
+        height = columns[stat_index][1]
+        ax = axs[stat_index // 2, stat_index % 2]
+        ax.set_title(stat)
+        bars.append(
             ax.bar(
                 x=[value for value in values],
                 width=0.75,
-                height=[(sample[:, stat_index] == value).sum() for value in values],
+                height=height,
                 edgecolor="black",
                 linewidth=0.75,
             )
+        )
+
+    if totals:
+        values, weights = columns[-1]
+        axs[3, 1].hist(values[weights > 0], weights=weights[weights > 0])
+    else:
+        axs[-1, -1].remove()
+
+    fig.tight_layout()
+    return fig, axs, bars
+
+
+class LivePlot:
+    """
+    The figure of `plot_columns`, shown while the sample is still being
+    generated. `update` sets the heights of the existing bars instead of
+    plotting them again, and skips redrawing until at least
+    `REFRESH_SECONDS` have passed, and long enough that drawing takes at
+    most `MAX_DRAW_SHARE` of the time.
+    """
+
+    REFRESH_SECONDS = 0.5
+    MAX_DRAW_SHARE = 0.1
+
+    def __init__(self, totals=False):
+        import matplotlib.pyplot as plt
+
+        self.plt = plt
+        self.totals = totals
+        plt.ion()
+        self.fig, self.axs, self.bars = plot_columns(
+            StatisticsAccumulator().columns(totals), totals
+        )
+        self.totals_range = None
+        if totals:
+            self.totals_color = self.axs[3, 1].patches[0].get_facecolor()
+        self.last_draw = -math.inf
+        self.draw_seconds = 0.0
+        plt.show()
+
+    def is_open(self) -> bool:
+        return self.plt.fignum_exists(self.fig.number)
+
+    def update(self, columns, force=False):
+        """Show the (values, counts) of `columns` if it's time to redraw"""
+        start = time.perf_counter()
+        wait = max(self.REFRESH_SECONDS, self.draw_seconds / self.MAX_DRAW_SHARE)
+        if not force and start - self.last_draw < wait:
+            return
+
+        for stat_index, bars in enumerate(self.bars):
+            counts = columns[stat_index][1]
+            for bar, count in zip(bars, counts):
+                bar.set_height(count)
+            ax = self.axs[stat_index // 2, stat_index % 2]
+            ax.set_ylim(0, max(counts.max(), 1) * 1.05)
+        if self.totals:
+            self.update_totals(*columns[-1])
 
-        if args.totals:
-            axs[3, 1].hist(sample[:, -1])
+        self.fig.tight_layout()  # For the widths of the new tick labels
+        self.fig.canvas.draw_idle()
+        self.fig.canvas.flush_events()
+        self.last_draw = time.perf_counter()
+        self.draw_seconds = self.last_draw - start
+
+    def update_totals(self, values, weights):
+        """
+        Set the heights of the bins of the histogram of weighed stat totals,
+        which is only plotted again when the range of the totals grew
+        """
+        ax = self.axs[3, 1]
+        seen = values[weights > 0]
+        if not len(seen):
+            return
+        if self.totals_range != (seen.min(), seen.max()):
+            self.totals_range = (seen.min(), seen.max())
+            for patch in list(ax.patches):
+                patch.remove()
+            ax.hist(seen, weights=weights[weights > 0], color=self.totals_color)
+            return
+        edges = np.histogram_bin_edges(seen)
+        heights, __ = np.histogram(seen, edges, weights=weights[weights > 0])
+        for patch, height in zip(ax.patches, heights):
+            patch.set_height(height)
+        ax.set_ylim(0, max(heights.max(), 1) * 1.05)
+
+
+def index_range(shorthand: str) -> range:
+    """Soldier indices as "I" or "START:STOP" """
+    start, colon, stop = shorthand.partition(":")
+    return range(int(start), int(stop) if colon else int(start) + 1)
+
+
+def print_soldiers(initializer, indices: range, seed, swaps=False, format="text"):
+    """
+    Print the stats of soldiers `indices` of the counter-based sample of
+    `seed`, and optionally the swap every roll applied, as `format`
+    """
+    deltas, applied = counter_deltas(
+        initializer, indices.start, indices.stop, seed, record=swaps
+    )
+    batch = SoldierBatch(deltas)
+    compiled = initializer.compile()
+    soldiers = []
+    for offset, index in enumerate(indices):
+        soldier: dict[str, Any] = {"index": index, "stats": batch.to_dict(offset)}
+        if applied is not None:
+            soldier["swaps"] = [
+                describe_swap(compiled.swaps[swap]) if swap >= 0 else None
+                for swap in applied[offset]
+                if swap != -2
+            ]
+        soldiers.append(soldier)
+
+    if format == "json":
+        json.dump(soldiers, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    for soldier in soldiers:
+        stats = ", ".join(f"{stat} {value}" for stat, value in soldier["stats"].items())
+        print(f"Soldier {soldier['index']}: {stats}")
+        for roll, swap in enumerate(soldier.get("swaps", ()), 1):
+            print(f"  Roll {roll}: {swap or 'no swap fit'}")
+
+
+def main(args):
+    initializer = INITIALIZERS[args.initializer]
+    if args.rolls is not None:
+        initializer.dice = args.rolls
+    backend = get_backend(args.backend).name
+    if args.index is not None:
+        print_soldiers(initializer, args.index, args.seed, args.swaps, args.format)
+        return
+
+    # Either way, only histograms and sums are kept, not the soldiers
+    live_plot = None
+    if args.progressive:
+        live_plot = LivePlot(args.totals)
+        distribution = StatisticsAccumulator()
+        if args.counter:
+            chunks = iter_counter_deltas(
+                initializer, args.number, args.seed, args.workers
+            )
         else:
-            axs[-1, -1].remove()
+            chunks = iter_deltas(
+                initializer, args.number, args.seed, args.workers, backend=backend
+            )
+        try:
+            for deltas in chunks:
+                distribution.update(deltas)
+                if not live_plot.is_open():
+                    break  # Stopped by closing the window
+                live_plot.update(distribution.columns(args.totals))
+        except KeyboardInterrupt:
+            pass
+        if live_plot.is_open():
+            live_plot.update(distribution.columns(args.totals), force=True)
+        if distribution.count < args.number and args.format == "text":
+            print("Stopped early, soldiers used:", distribution.count)
+    elif args.exact:
+        from exact import exact_distribution
+
+        distribution = exact_distribution(initializer)
+    elif args.precision is not None:
+        distribution = precise_statistics(
+            initializer,
+            args.precision,
+            seed=args.seed,
+            workers=args.workers,
+            max_n=args.number,
+            totals=args.totals,
+            backend=backend,
+        )
+        if args.format == "text":
+            print("Soldiers used:", distribution.count)
+    elif args.stratify:
+        distribution = stratified_statistics(
+            initializer,
+            args.number,
+            seed=args.seed,
+            workers=args.workers,
+            allocation=args.stratify,
+            backend=backend,
+        )
+    elif args.input:
+        distribution = array_statistics(SoldierBatch.load(args.input).deltas)
+    elif args.output:
+        distribution = accumulate(
+            iter_deltas_to_file(
+                initializer,
+                args.number,
+                args.output,
+                args.seed,
+                args.workers,
+                backend,
+            )
+        )
+    elif args.counter:
+        distribution = accumulate(
+            iter_counter_deltas(initializer, args.number, args.seed, args.workers)
+        )
+    elif args.profile_sampler:
+        profile = SamplerProfile(len(initializer.compile().swaps))
+        distribution = accumulate(
+            iter_deltas(
+                initializer, args.number, args.seed, args.workers, profile=profile
+            )
+        )
+    else:
+        distribution = sample_statistics(
+            initializer,
+            args.number,
+            seed=args.seed,
+            workers=args.workers,
+            cache=args.cache,
+            backend=backend,
+        )
+    columns = distribution.columns(args.totals)
+
+    if args.statistics and args.statistics_output:
+        with open(args.statistics_output, "w", newline="") as file:
+            write_statistics(distribution, args, file)
+    elif args.statistics:
+        write_statistics(distribution, args, sys.stdout)
+
+    if args.profile_sampler:
+        # Not in the way of json or csv statistics on stdout
+        file = sys.stdout if args.format == "text" else sys.stderr
+        print(f"Sampler profile of {args.initializer}:", file=file)
+        print(profile.report(initializer.swap_table), file=file)
 
-        fig.tight_layout()
+    if args.plt_show:
+        import matplotlib.pyplot as plt
+
+        if live_plot is None:
+            plot_columns(columns, args.totals)
+        else:
+            plt.ioff()  # Keep the window open until it's closed
         plt.show()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("python soldierstats.py")
     parser.add_argument(
-        "-n", "--number", type=int, help="Number of soldiers to generate", required=True
+        "-n", "--number", type=int, help="Number of soldiers to generate"
     )
     parser.add_argument(
         "--rolls",
@@ -101,11 +433,212 @@ if __name__ == "__main__":
         action="store_true",
         help="Show a MatPlotLib window with the results",
     )
+    parser.add_argument(
+        "--progressive",
+        action="store_true",
+        help="With --show, show the histograms while the sample is generated, "
+        "a block at a time; close the window or press Ctrl+C to stop early",
+    )
     parser.add_argument(
         "--statistics",
         action="store_true",
         # help="Calculate statistics of the input and append them to the given file"
     )
+    parser.add_argument(
+        "--format",
+        choices=("text", "json", "csv"),
+        default="text",
+        help="Format of the statistics",
+    )
+    parser.add_argument(
+        "--statistics-output",
+        metavar="FILE",
+        help="Write the statistics to this file instead of stdout",
+    )
+    parser.add_argument(
+        "--exact",
+        action="store_true",
+        help="Use the exact distribution of the initializer instead of a sample",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to generate the sample with",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=("auto", *BACKENDS),
+        default="numpy",
+        help='How to roll the soldiers; "auto" is the fastest one installed. '
+        "The default is numpy rather than auto, because numba rolls different "
+        "soldiers, so with auto a seed's soldiers would depend on what is installed",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for the sample; the same seed and backend give the same sample "
+        "with any number of workers; a larger -n starts with the same soldiers "
+        f"only up to the last whole block of {BLOCK_SIZE} of a smaller one",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Read the sample from, and save it to, the sample cache (needs --seed)",
+    )
+    parser.add_argument(
+        "--counter",
+        action="store_true",
+        help="Roll every soldier from its own counter-based random numbers, "
+        "so that it can be rolled again on its own with --index (needs --seed)",
+    )
+    parser.add_argument(
+        "--index",
+        type=index_range,
+        metavar="I or START:STOP",
+        help="Only print the stats of these soldiers of the --counter sample of "
+        "--seed, without rolling the others",
+    )
+    parser.add_argument(
+        "--swaps",
+        action="store_true",
+        help="With --index, also print the swap of every roll",
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE.npy",
+        help="Also save the stat deltas of the sample to this file, a block at a time",
+    )
+    parser.add_argument(
+        "--input",
+        metavar="FILE.npy",
+        help="Use the sample saved by --output instead of generating one",
+    )
+    parser.add_argument(
+        "--precision-mean",
+        type=float,
+        help="Generate until the 95%% confidence intervals of the means are at most "
+        "this wide on either side, in the units of every stat; -n is then the most "
+        "soldiers to generate",
+    )
+    parser.add_argument(
+        "--precision-prob",
+        type=float,
+        help="Likewise for the probabilities of the histogram bars",
+    )
+    parser.add_argument(
+        "--precision-corr",
+        type=float,
+        help="Likewise for the correlations",
+    )
+    parser.add_argument(
+        "--stratify",
+        choices=ALLOCATIONS,
+        help="Stratify the sample by number of swaps, with soldiers allocated to "
+        "every number in proportion to its probability, or optimally by how much "
+        "the stats vary with it. The means gain nothing, and the histograms of "
+        "the default dice gain only about 1%% of their variance; it pays off with "
+        "a single wide die like --rolls 1d20",
+    )
+    parser.add_argument(
+        "--profile-sampler",
+        action="store_true",
+        help="Count the tries of every roll of the sample and report them, "
+        "with the numpy backend",
+    )
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers has to be positive")
+    # The half-widths of every kind to reach, or None without any
+    args.precision = {
+        kind: value
+        for kind, value in (
+            ("mean", args.precision_mean),
+            ("probability", args.precision_prob),
+            ("correlation", args.precision_corr),
+        )
+        if value is not None
+    } or None
+    if args.precision is not None and min(args.precision.values()) <= 0:
+        parser.error(
+            "--precision-mean, --precision-prob and --precision-corr "
+            "have to be positive"
+        )
+    if args.number is None and (
+        args.profile_sampler
+        or not (args.exact or args.input or args.precision or args.index)
+    ):
+        parser.error("the following arguments are required: -n/--number")
+    if args.cache and args.seed is None:
+        parser.error("--cache needs a --seed")
+    if args.cache and (args.exact or args.input or args.output or args.precision):
+        parser.error(
+            "--cache can't be combined with --exact, --input, --output "
+            "or --precision-*"
+        )
+    if (args.counter or args.index) and args.seed is None:
+        parser.error("--counter and --index need a --seed")
+    if args.swaps and not args.index:
+        parser.error("--swaps needs --index")
+    if args.output and (args.exact or args.input or args.precision or args.stratify):
+        parser.error(
+            "--output can't be combined with --exact, --input, --precision-* "
+            "or --stratify"
+        )
+    if args.counter and (
+        args.exact
+        or args.input
+        or args.output
+        or args.precision
+        or args.stratify
+        or args.cache
+    ):
+        parser.error(
+            "--counter can't be combined with --exact, --input, --output, "
+            "--precision-*, --stratify or --cache"
+        )
+    if args.progressive and not args.plt_show:
+        parser.error("--progressive needs --show")
+    # A file of a run stopped early would end in rows of default stats,
+    # which --input would take for soldiers
+    if args.progressive and (
+        args.exact
+        or args.input
+        or args.output
+        or args.precision
+        or args.stratify
+        or args.cache
+    ):
+        parser.error(
+            "--progressive can't be combined with --exact, --input, --output, "
+            "--precision-*, --stratify or --cache"
+        )
+    if args.profile_sampler and (
+        args.exact
+        or args.input
+        or args.output
+        or args.precision
+        or args.stratify
+        or args.counter
+        or args.cache
+        or args.progressive
+    ):
+        parser.error(
+            "--profile-sampler can't be combined with --exact, --input, --output, "
+            "--precision-*, --stratify, --counter, --cache or --progressive"
+        )
+    try:
+        if args.profile_sampler and get_backend(args.backend).name != "numpy":
+            parser.error("--profile-sampler needs the numpy backend")
+    except ValueError as error:
+        parser.error(str(error))
+    if args.stratify and (
+        args.exact or args.cache or args.input or args.output or args.precision
+    ):
+        parser.error(
+            "--stratify can't be combined with --exact, --cache, --input, --output "
+            "or --precision-*"
+        )
 
     main(args)
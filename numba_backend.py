@@ -0,0 +1,68 @@
+"""
+The per-soldier loop of `StatSwapper.__call__`, compiled with Numba.
+
+Only imported by `backends` when the "numba" backend is used, since
+Numba is optional and slow to import.
+"""
+import numba
+import numpy as np
+from numpy.typing import NDArray
+
+from batch import MAX_DELTAS, MIN_DELTAS, alias_draws, swap_deltas
+from soldier import MAX_TRIES, StatSwapper
+
+
+@numba.njit(cache=True)
+def roll_soldiers(seed, rolls, deltas, probability, alias, min_deltas, max_deltas):
+    """
+    Stat deltas of soldiers that get `rolls` swaps each, where every swap
+    is drawn from the alias table of the rows of `deltas` until one fits
+    """
+    np.random.seed(seed)
+    sample = np.zeros((len(rolls), deltas.shape[1]), dtype=np.int16)
+    for soldier in range(len(rolls)):
+        for __ in range(rolls[soldier]):
+            for __ in range(MAX_TRIES):
+                uniform = np.random.random() * len(probability)
+                index = int(uniform)
+                if uniform - index >= probability[index]:
+                    index = alias[index]
+                fits = True
+                for stat in range(deltas.shape[1]):
+                    value = sample[soldier, stat] + deltas[index, stat]
+                    if value < min_deltas[stat] or value > max_deltas[stat]:
+                        fits = False
+                        break
+                if fits:
+                    for stat in range(deltas.shape[1]):
+                        sample[soldier, stat] += deltas[index, stat]
+                    break
+    return sample
+
+
+def generate_deltas(
+    initializer: StatSwapper,
+    n: int,
+    rng: int | np.random.SeedSequence | np.random.Generator | None = None,
+    rolls: int | None = None,
+) -> NDArray:
+    """`batch.generate_deltas`, one soldier at a time in compiled code"""
+    rng = np.random.default_rng(rng)
+    compiled = initializer.compile()
+    # The number of swaps of every soldier
+    if rolls is None:
+        soldier_rolls = alias_draws(compiled.rolls, rng.random(n))
+    else:
+        soldier_rolls = np.full(n, rolls)
+    deltas, __ = swap_deltas(initializer)
+    if not len(deltas):
+        return np.zeros([n, len(MIN_DELTAS)], dtype=np.int16)
+    return roll_soldiers(
+        rng.integers(2**32, dtype=np.uint32),
+        soldier_rolls.astype(np.int64),
+        deltas,
+        np.array(compiled.swap_alias.probability),
+        np.array(compiled.swap_alias.alias),
+        MIN_DELTAS.astype(np.int16),
+        MAX_DELTAS.astype(np.int16),
+    )
@@ -0,0 +1,233 @@
+"""
+Search for swap table weights that give a target distribution of stats.
+
+Candidates are tables with the same swaps as a starting initializer but
+different weights, and optionally a different number of dice. They are
+scored by how far their marginals are from target marginals and how far
+the correlations between different stats are from a target correlation.
+The search is a differential evolution, which scores a whole population
+of candidates at a time, in parallel.
+
+    python optimize.py --initializer ancev3 --target-correlation 0 --workers 8
+"""
+import argparse
+import json
+
+import numpy as np
+from numpy.typing import NDArray
+from scipy.optimize import Bounds, differential_evolution
+
+from accumulator import sample_statistics
+from batch import SPANS, STAT_NAMES
+from exact import exact_distribution
+from soldier import INITIALIZERS, StatSwapper
+
+# Bounds of every weight, relative to the weights of the starting table
+WEIGHT_RANGE = (1 / 20, 20)
+MAX_DICE = 20
+
+
+class Objective:
+    """
+    The loss of every candidate, as a picklable callable so that
+    candidates can be scored in worker processes
+    """
+
+    def __init__(
+        self,
+        initializer: StatSwapper,
+        target_marginals: dict[str, NDArray] | None = None,
+        target_correlation: float | None = None,
+        evaluator: str = "sample",
+        n: int = 20_000,
+        seed: int = 0,
+        optimize_dice: bool = False,
+    ):
+        self.initializer = initializer
+        self.target_marginals = target_marginals or {}
+        self.target_correlation = target_correlation
+        self.evaluator = evaluator
+        self.n = n
+        self.seed = seed  # The same for every candidate, to compare them fairly
+        self.optimize_dice = optimize_dice
+
+    def candidate(self, x: NDArray) -> StatSwapper:
+        """The initializer that the point `x` of the search space stands for"""
+        table = self.initializer.swap_table
+        weights = np.exp(x[: len(table)])
+        swap_table = tuple(
+            swap._replace(Weight=float(weight)) for swap, weight in zip(table, weights)
+        )
+        dice = self.initializer.dice
+        if self.optimize_dice:
+            dice = round(x[-1]) * (dice[0],)
+        return StatSwapper(dice, swap_table)
+
+    def evaluate(self, initializer: StatSwapper):
+        """The marginals and the correlation matrix of `initializer`"""
+        if self.evaluator == "exact":
+            distribution = exact_distribution(initializer)
+            return distribution.marginals, distribution.correlation()
+        statistics = sample_statistics(initializer, self.n, self.seed)
+        marginals = {
+            stat: counts / statistics.count
+            for stat, counts in statistics.marginals.items()
+        }
+        return marginals, statistics.correlation()
+
+    def loss(self, initializer: StatSwapper) -> float:
+        marginals, correlation = self.evaluate(initializer)
+        loss = sum(
+            ((marginals[stat] - target) ** 2).sum()
+            for stat, target in self.target_marginals.items()
+        )
+        if self.target_correlation is not None:
+            off_diagonal = correlation[np.triu_indices(len(STAT_NAMES), 1)]
+            # Stats that never change aren't correlated with anything
+            off_diagonal = np.nan_to_num(off_diagonal, nan=self.target_correlation)
+            loss += ((off_diagonal - self.target_correlation) ** 2).sum()
+        return float(loss)
+
+    def __call__(self, x: NDArray) -> float:
+        return self.loss(self.candidate(x))
+
+
+def optimize(
+    objective: Objective, workers: int = 1, maxiter: int = 50, popsize: int = 5, seed=0
+) -> StatSwapper:
+    """The best initializer found for `objective`, with its weights rounded"""
+    table = objective.initializer.swap_table
+    weights = np.log([swap.Weight for swap in table])
+    lower = list(weights + np.log(WEIGHT_RANGE[0]))
+    upper = list(weights + np.log(WEIGHT_RANGE[1]))
+    start = list(weights)
+    integrality = [False] * len(table)
+    if objective.optimize_dice:
+        lower.append(1)
+        upper.append(MAX_DICE)
+        start.append(len(objective.initializer.dice))
+        integrality.append(True)
+
+    result = differential_evolution(
+        objective,
+        Bounds(lower, upper),
+        x0=start,
+        integrality=integrality,
+        maxiter=maxiter,
+        popsize=popsize,
+        seed=seed,
+        workers=workers,
+        updating="deferred" if workers != 1 else "immediate",
+        polish=False,
+    )
+    best = objective.candidate(result.x)
+    best.swap_table = tuple(
+        swap._replace(Weight=round(swap.Weight, 3)) for swap in best.swap_table
+    )
+    return best
+
+
+def format_table(name: str, swap_table) -> str:
+    """`swap_table` as Python source, like the tables in soldier.py"""
+    lines = [f"{name} = ("]
+    for swap in swap_table:
+        lines.append(
+            f'    StatSwap("{swap.StatUp}", {swap.StatUp_Amount}, '
+            f'"{swap.StatDown}", {swap.StatDown_Amount}, {swap.Weight}),'
+        )
+    lines.append(")")
+    return "\n".join(lines)
+
+
+def read_marginals(path) -> dict[str, NDArray]:
+    """
+    Target marginals from a JSON file of {stat: [probability of every value,
+    from the smallest to the largest]}, which are normalized to sum to 1.
+    Raises ValueError for unknown stats and lists of the wrong length.
+    """
+    with open(path) as file:
+        marginals = json.load(file)
+    if not isinstance(marginals, dict):
+        raise ValueError(f"{path} isn't a JSON object of stats")
+    for stat, probabilities in marginals.items():
+        if stat not in STAT_NAMES:
+            raise ValueError(f"{path}: unknown stat {stat!r}")
+        span = SPANS[STAT_NAMES.index(stat)]
+        if not isinstance(probabilities, list) or len(probabilities) != span:
+            raise ValueError(f"{path}: {stat} needs a list of {span} probabilities")
+        if min(probabilities) < 0 or not sum(probabilities) > 0:
+            raise ValueError(
+                f"{path}: {stat} needs non-negative probabilities with a positive sum"
+            )
+    return {
+        stat: np.array(probabilities) / np.sum(probabilities)
+        for stat, probabilities in marginals.items()
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("python optimize.py")
+    parser.add_argument(
+        "--initializer",
+        choices=INITIALIZERS,
+        help="Which initializer's table to start from",
+        required=True,
+    )
+    parser.add_argument(
+        "--target-marginals",
+        metavar="FILE.json",
+        help="JSON file of {stat: [probability of every value]} to aim for",
+    )
+    parser.add_argument(
+        "--target-correlation",
+        type=float,
+        help="Correlation to aim for between every two different stats",
+    )
+    parser.add_argument(
+        "--evaluator",
+        choices=("sample", "exact"),
+        default="sample",
+        help="Score candidates by a sample, or exactly (only fast for ANCE tables)",
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        default=20_000,
+        help="Number of soldiers to score every candidate with",
+    )
+    parser.add_argument(
+        "--dice",
+        action="store_true",
+        help="Also optimize the number of dice",
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--maxiter", type=int, default=50)
+    parser.add_argument("--popsize", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers has to be positive")
+    if args.target_marginals is None and args.target_correlation is None:
+        parser.error("nothing to optimize for without a target")
+    if args.target_marginals is not None:
+        try:
+            args.target_marginals = read_marginals(args.target_marginals)
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+
+    initializer = INITIALIZERS[args.initializer]
+    objective = Objective(
+        initializer,
+        args.target_marginals,
+        args.target_correlation,
+        args.evaluator,
+        args.number,
+        args.seed,
+        args.dice,
+    )
+    print("Loss before:", objective.loss(initializer))
+    best = optimize(objective, args.workers, args.maxiter, args.popsize, args.seed)
+    print("Loss after:", objective.loss(best))
+    print(f"# Dice: {len(best.dice)}d{best.dice[0]}")
+    print(format_table(f"{args.initializer.upper()}_OPTIMIZED_SWAPS", best.swap_table))
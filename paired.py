@@ -0,0 +1,274 @@
+"""
+Comparisons of initializers on common random numbers.
+
+Two independent samples differ by the noise of both, on top of the actual
+difference between the initializers. Here every initializer instead rolls
+the same soldiers: soldier `i` gets the same uniform numbers from the
+counter-based generator of `counter` under every initializer, number
+`draw` of `batch.roll_soldiers` for the same draw. The dice sums and
+swaps are drawn by inverse cumulative probabilities, in
+`batch.coupling_order`, so the same numbers roll about as many swaps, and
+swaps of the same stats where the tables have them. The noise the samples
+share then cancels out of their differences.
+
+How much it cancels depends on how alike the tables are: differences
+between the ANCE tables need several times fewer soldiers than with
+independent samples, but the LWOTC table trades stats against each other
+where ANCE raises them one at a time, so against ANCE it mostly gains on
+Offense. The gain of every difference is reported along with it.
+
+The errors come from batch means: the soldiers are split by index into
+`NUM_BATCHES` batches, and the spread of the differences between batches
+gives Student's t intervals of the differences of the whole sample.
+
+    python paired.py --initializer lwotc ancev3 -n 4000000 --workers 8
+"""
+import argparse
+from collections import namedtuple
+from functools import partial
+from itertools import combinations
+
+import numpy as np
+from numpy.typing import NDArray
+from scipy import stats
+
+from accumulator import StatisticsAccumulator
+from batch import BLOCK_SIZE, STAT_NAMES, iter_blocks, roll_soldiers
+from counter import counter_key, counter_uniforms
+from soldier import INITIALIZERS, StatSwapper
+
+NUM_BATCHES = 32
+# Fewer soldiers per batch leave the correlations of a batch undefined
+MIN_BATCH_SIZE = 100
+TOTALS_NAME = "WeighedStatTotal"
+
+# Every field is a dict of arrays like `StatisticsAccumulator.half_widths`:
+# "mean" of every stat and the weighed stat total, "probability" of every
+# histogram bin of those, and "correlation" of every pair of stats
+PairedComparison = namedtuple(
+    "PairedComparison",
+    ("initializer", "baseline", "count", "difference", "half_width", "gain"),
+)
+
+
+def paired_deltas(
+    initializers: list[StatSwapper], start: int, stop: int, key
+) -> list[NDArray]:
+    """
+    The stat deltas of soldiers `start:stop` of every initializer,
+    all rolled from the same uniform numbers of the Philox `key`
+    """
+    indices = np.arange(start, stop, dtype=np.uint64)
+
+    def uniforms(soldiers, draw):
+        return counter_uniforms(
+            key, indices[soldiers], np.full(len(soldiers), draw, dtype=np.uint64)
+        )
+
+    return [
+        roll_soldiers(initializer, len(indices), uniforms, coupled=True)[0]
+        for initializer in initializers
+    ]
+
+
+def _paired_block(initializers, start, stop, key):
+    return paired_deltas(initializers, start, stop, key), None
+
+
+def iter_paired_deltas(
+    initializers: list[StatSwapper],
+    n: int,
+    seed: int | np.random.SeedSequence | None = None,
+    workers: int = 1,
+):
+    """(start, `paired_deltas`) of every block of `BLOCK_SIZE` soldiers of `n`"""
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)  # The same key in every process
+    key = counter_key(seed)
+    ranges = [
+        (start, min(start + BLOCK_SIZE, n), key) for start in range(0, n, BLOCK_SIZE)
+    ]
+    roll = partial(_paired_block, initializers)
+    samples = iter_blocks(roll, ranges, workers, arrays=len(initializers))
+    for block, (deltas, __) in zip(ranges, samples):
+        yield block[0], deltas
+
+
+def estimates(statistics: StatisticsAccumulator) -> dict[str, NDArray]:
+    """The quantities that are compared, keyed like `PairedComparison` fields"""
+    return {
+        "mean": statistics.mean(totals=True),
+        "probability": np.concatenate(
+            [counts / statistics.count for __, counts in statistics.columns(True)]
+        ),
+        # Stats that never change are taken as uncorrelated
+        "correlation": np.nan_to_num(
+            statistics.correlation()[np.triu_indices(len(STAT_NAMES), 1)]
+        ),
+    }
+
+
+class PairedStatistics:
+    """
+    Statistics of every initializer on the same soldiers, each kept as
+    `NUM_BATCHES` `StatisticsAccumulator`s of the soldiers with the same
+    index modulo `NUM_BATCHES`
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.batches = {
+            name: [StatisticsAccumulator() for __ in range(NUM_BATCHES)]
+            for name in self.names
+        }
+
+    @property
+    def count(self) -> int:
+        return sum(batch.count for batch in self.batches[self.names[0]])
+
+    def update(self, start: int, samples: list[NDArray]) -> "PairedStatistics":
+        """Add soldiers `start:` of every initializer, in the order of `names`"""
+        for name, deltas in zip(self.names, samples):
+            for batch, accumulator in enumerate(self.batches[name]):
+                accumulator.update(deltas[(batch - start) % NUM_BATCHES :: NUM_BATCHES])
+        return self
+
+    def statistics(self, name: str) -> StatisticsAccumulator:
+        """The statistics of every soldier of initializer `name`"""
+        merged = StatisticsAccumulator()
+        for accumulator in self.batches[name]:
+            merged.merge(accumulator)
+        return merged
+
+    def compare(
+        self, name: str, baseline: str, confidence: float = 0.95
+    ) -> PairedComparison:
+        """
+        The differences of initializer `name` from `baseline`, with the
+        half-widths of their intervals and their gains: how many times
+        as many soldiers two independent samples need for the same width
+        """
+        whole = estimates(self.statistics(name))
+        whole_baseline = estimates(self.statistics(baseline))
+        batches = [estimates(batch) for batch in self.batches[name]]
+        batches_baseline = [estimates(batch) for batch in self.batches[baseline]]
+        t = stats.t.ppf((1 + confidence) / 2, NUM_BATCHES - 1)
+
+        difference, half_width, gain = {}, {}, {}
+        for quantity in whole:
+            values = np.array([batch[quantity] for batch in batches])
+            values_baseline = np.array([batch[quantity] for batch in batches_baseline])
+            spread = (values - values_baseline).var(0, ddof=1)
+            difference[quantity] = whole[quantity] - whole_baseline[quantity]
+            half_width[quantity] = t * np.sqrt(spread / NUM_BATCHES)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                gain[quantity] = (
+                    values.var(0, ddof=1) + values_baseline.var(0, ddof=1)
+                ) / spread
+        return PairedComparison(
+            name, baseline, self.count, difference, half_width, gain
+        )
+
+
+def paired_statistics(
+    initializers: dict[str, StatSwapper],
+    n: int,
+    seed: int | np.random.SeedSequence | None = None,
+    workers: int = 1,
+) -> PairedStatistics:
+    """`PairedStatistics` of `n` soldiers rolled by every one of `initializers`"""
+    if n < NUM_BATCHES * MIN_BATCH_SIZE:
+        raise ValueError(
+            f"a paired sample needs at least {NUM_BATCHES * MIN_BATCH_SIZE} soldiers"
+        )
+    statistics = PairedStatistics(initializers)
+    for start, samples in iter_paired_deltas(
+        list(initializers.values()), n, seed, workers
+    ):
+        statistics.update(start, samples)
+    return statistics
+
+
+def quantity_names(quantity: str) -> list[str]:
+    """What every value of a `PairedComparison` quantity is of"""
+    if quantity == "mean":
+        return STAT_NAMES + [TOTALS_NAME]
+    if quantity == "correlation":
+        return [f"{stat_1}/{stat_2}" for stat_1, stat_2 in combinations(STAT_NAMES, 2)]
+    statistics = StatisticsAccumulator()
+    return [
+        f"{name} = {value}"
+        for name, (values, __) in zip(
+            STAT_NAMES + [TOTALS_NAME], statistics.columns(True)
+        )
+        for value in values
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("python paired.py")
+    parser.add_argument(
+        "--initializer",
+        nargs="+",
+        choices=INITIALIZERS,
+        default=["lwotc", "ancev3"],
+        help="Initializers to compare; every one after the first "
+        "is compared to the first",
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        default=1_000_000,
+        help="Number of soldiers every initializer rolls",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to roll the soldiers with",
+    )
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument(
+        "--marginals",
+        action="store_true",
+        help="Also compare the probability of every histogram bin",
+    )
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers has to be positive")
+    if len(set(args.initializer)) < 2:
+        parser.error("--initializer needs at least two different initializers")
+    if args.number < NUM_BATCHES * MIN_BATCH_SIZE:
+        parser.error(f"-n needs to be at least {NUM_BATCHES * MIN_BATCH_SIZE}")
+
+    names = list(dict.fromkeys(args.initializer))
+    statistics = paired_statistics(
+        {name: INITIALIZERS[name] for name in names},
+        args.number,
+        args.seed,
+        args.workers,
+    )
+    quantities = ["mean", "correlation"] + ["probability"] * args.marginals
+    for name in names[1:]:
+        comparison = statistics.compare(name, names[0], args.confidence)
+        print(
+            f"{name} - {names[0]}, {comparison.count} paired soldiers, "
+            f"{args.confidence:.0%} confidence intervals, and the gain "
+            "over independent samples of the same size"
+        )
+        for quantity in quantities:
+            print(f"{quantity.capitalize()}:")
+            for index, label in enumerate(quantity_names(quantity)):
+                difference = comparison.difference[quantity][index]
+                if quantity == "probability" and not (
+                    difference or comparison.half_width[quantity][index]
+                ):
+                    continue  # Bins neither initializer ever rolls
+                print(
+                    f"  {label:<24} {difference:+.4g} "
+                    f"± {comparison.half_width[quantity][index]:.2g}  "
+                    f"(gain {comparison.gain[quantity][index]:.3g}x)"
+                )
+        print()
@@ -0,0 +1,297 @@
+"""
+Probabilities of rare combinations of stats, by importance sampling.
+
+A query is a box of stat values, like Offense >= 75 and Mobility >= 18.
+Soldiers are rolled with tilted probabilities of the dice sum and of every
+swap, which make the box more likely, and every soldier in the box counts
+with the likelihood ratio of its rolls: the product of the probabilities
+of every draw it made, untilted over tilted. The estimate is unbiased for
+any tilt, but only has a small variance for a good one, which is found
+with the cross-entropy method: roll a pilot sample, fit the tilt to the
+soldiers closest to the box, and repeat until those are in it.
+
+    python rare.py --initializer lwotc "Offense>=75" "Mobility>=18" --exact
+"""
+import argparse
+import math
+import re
+from collections import namedtuple
+from statistics import NormalDist
+
+import numpy as np
+from numpy.typing import NDArray
+
+from batch import (
+    MAX_DELTAS,
+    MIN_DELTAS,
+    SPANS,
+    STAT_NAMES,
+    alias_draws,
+    swap_deltas,
+)
+from soldier import (
+    INITIALIZERS,
+    MAX_TRIES,
+    Soldier,
+    Stat,
+    StatSwapper,
+    alias_table,
+    dice_sum_distribution,
+)
+
+# Share of the pilot soldiers that the tilt is fitted to
+ELITE_FRACTION = 0.1
+# How much of the fitted tilt replaces the previous one every round
+SMOOTHING = 0.7
+# Share of the untilted probabilities always kept in the tilt, which keeps
+# the likelihood ratio of every draw at most 1 / UNTILTED_SHARE
+UNTILTED_SHARE = 0.01
+MAX_ROUNDS = 30
+# Rounds without getting closer to the box before the fitting gives up,
+# like for boxes that can't be reached at all
+MAX_STALLED_ROUNDS = 3
+
+Tilt = namedtuple("Tilt", ("rolls", "swaps"))
+TailEstimate = namedtuple(
+    "TailEstimate", ("probability", "low", "high", "n", "relative_error", "tilt")
+)
+
+
+def parse_condition(
+    condition: str, ranges: dict[str, Stat] = Soldier.STATS
+) -> tuple[str, int, int]:
+    """
+    (stat, lowest value, highest value) of a condition like "Offense>=75",
+    on any of the stats of `ranges`
+    """
+    match = re.fullmatch(r"\s*(\w+)\s*(>=|<=|==|=)\s*(-?\d+)\s*", condition)
+    if not match or match[1] not in ranges:
+        raise ValueError(f"invalid condition {condition!r}")
+    stat, operator, value = match[1], match[2], int(match[3])
+    range_ = ranges[stat]
+    lowest = range_.default + range_.min_delta
+    highest = range_.default + range_.max_delta
+    if operator == ">=":
+        return stat, value, highest
+    if operator == "<=":
+        return stat, lowest, value
+    return stat, value, value
+
+
+def query_bounds(conditions) -> tuple[NDArray, NDArray]:
+    """The lowest and highest stat deltas of the box of every condition"""
+    low, high = MIN_DELTAS.copy(), MAX_DELTAS.copy()
+    for stat, lowest, highest in conditions:
+        index = STAT_NAMES.index(stat)
+        default = Soldier.STATS[stat].default
+        low[index] = max(low[index], lowest - default)
+        high[index] = min(high[index], highest - default)
+    return low, high
+
+
+def distances(deltas: NDArray, low: NDArray, high: NDArray) -> NDArray:
+    """How far every soldier is from the box, as shares of the stat ranges"""
+    outside = np.maximum(low - deltas, 0) + np.maximum(deltas - high, 0)
+    return (outside / (SPANS - 1)).sum(1)
+
+
+def untilted(initializer: StatSwapper) -> Tilt:
+    """The probabilities that `initializer` rolls with"""
+    __, swaps = swap_deltas(initializer)
+    return Tilt(np.array(dice_sum_distribution(initializer.dice)), swaps)
+
+
+def tilted_deltas(
+    initializer: StatSwapper, tilt: Tilt, n: int, rng: np.random.Generator
+) -> tuple[NDArray, NDArray, NDArray, NDArray]:
+    """
+    `n` soldiers rolled like by `batch.generate_deltas`, but with the dice
+    sum and every swap drawn with the probabilities of `tilt`. Returns
+    their stat deltas, their log likelihood ratios, their number of rolls
+    and the number of times every swap was drawn, (n, swaps).
+    """
+    base = untilted(initializer)
+    deltas = swap_deltas(initializer)[0]
+    sample = np.zeros([n, len(STAT_NAMES)], dtype=np.int16)
+    rolls = alias_draws(alias_table(tilt.rolls), rng.random(n))
+    draws = np.zeros([n, len(deltas)], dtype=np.int64)
+    swap_alias = alias_table(tilt.swaps)
+    for step in range(rolls.max(initial=0)):
+        pending = np.flatnonzero(rolls > step)
+        for __ in range(MAX_TRIES):
+            drawn = alias_draws(swap_alias, rng.random(len(pending)))
+            draws[pending, drawn] += 1  # Every pending soldier once
+            swapped = sample[pending] + deltas[drawn]
+            valid = ((swapped >= MIN_DELTAS) & (swapped <= MAX_DELTAS)).all(1)
+            sample[pending[valid]] = swapped[valid]
+            pending = pending[~valid]
+            if not len(pending):
+                break
+
+    with np.errstate(divide="ignore"):
+        log_ratios = np.log(base.rolls[rolls] / tilt.rolls[rolls]) + draws @ np.log(
+            base.swaps / tilt.swaps
+        )
+    return sample, log_ratios, rolls, draws
+
+
+def fit_tilt(
+    initializer: StatSwapper,
+    low: NDArray,
+    high: NDArray,
+    n: int,
+    rng: np.random.Generator,
+) -> Tilt:
+    """The tilt toward the box of the cross-entropy method, from pilot samples of `n`"""
+    base = untilted(initializer)
+    tilt = base
+    closest, stalled = math.inf, 0
+    for __ in range(MAX_ROUNDS):
+        sample, log_ratios, rolls, draws = tilted_deltas(initializer, tilt, n, rng)
+        distance = distances(sample, low, high)
+        threshold = max(np.quantile(distance, ELITE_FRACTION), 0)
+        elites = distance <= threshold
+        # Likelihood ratios to the untilted process, scaled to stay in range
+        weights = np.exp(log_ratios[elites] - log_ratios[elites].max())
+
+        fitted = Tilt(
+            np.bincount(rolls[elites], weights, minlength=len(base.rolls)),
+            weights @ draws[elites],
+        )
+        tilt = Tilt(
+            *(
+                UNTILTED_SHARE * untilted_
+                + (1 - UNTILTED_SHARE)
+                * (SMOOTHING * fitted_ / fitted_.sum() + (1 - SMOOTHING) * tilt_)
+                for untilted_, fitted_, tilt_ in zip(base, fitted, tilt)
+            )
+        )
+        if threshold == 0:
+            break
+        if threshold < closest:
+            closest, stalled = threshold, 0
+        else:
+            stalled += 1
+            if stalled == MAX_STALLED_ROUNDS:
+                break
+    return tilt
+
+
+def tail_probability(
+    initializer: StatSwapper,
+    conditions,
+    n: int = 100_000,
+    seed: int | np.random.SeedSequence | None = None,
+    confidence: float = 0.95,
+    pilot_n: int | None = None,
+) -> TailEstimate:
+    """
+    The probability that a soldier rolls stats that meet every condition
+    of `parse_condition`, estimated from `n` importance-sampled soldiers
+    after fitting the tilt to pilot samples of `pilot_n`
+    """
+    rng = np.random.default_rng(seed)
+    low, high = query_bounds(conditions)
+    tilt = fit_tilt(initializer, low, high, pilot_n or n // 10, rng)
+    sample, log_ratios, __, __ = tilted_deltas(initializer, tilt, n, rng)
+    inside = distances(sample, low, high) == 0
+    values = np.where(inside, np.exp(log_ratios), 0)
+
+    probability = values.mean()
+    error = values.std(ddof=1) / math.sqrt(n)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    return TailEstimate(
+        probability,
+        max(probability - z * error, 0),
+        probability + z * error,
+        n,
+        error / probability if probability else math.inf,
+        tilt,
+    )
+
+
+def exact_tail_probability(initializer: StatSwapper, conditions) -> float | None:
+    """
+    The exact probability of the conditions, from the marginals and
+    pairwise joints of `exact.exact_distribution`, if they are about at
+    most two stats
+    """
+    from exact import exact_distribution
+
+    low, high = query_bounds(conditions)
+    stats = sorted({STAT_NAMES.index(stat) for stat, __, __ in conditions})
+    if len(stats) > 2:
+        return None
+    distribution = exact_distribution(initializer)
+    boxes = [slice(low[i] - MIN_DELTAS[i], high[i] - MIN_DELTAS[i] + 1) for i in stats]
+    if len(stats) == 1:
+        return float(distribution.marginals[STAT_NAMES[stats[0]]][boxes[0]].sum())
+    joint = distribution.joint(STAT_NAMES[stats[0]], STAT_NAMES[stats[1]])
+    return float(joint[boxes[0], boxes[1]].sum())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("python rare.py")
+    parser.add_argument(
+        "--initializer",
+        choices=INITIALIZERS,
+        help="Which initializer to use",
+        required=True,
+    )
+    parser.add_argument(
+        "conditions",
+        nargs="+",
+        metavar="CONDITION",
+        help='Conditions on stat values that all have to hold, like "Offense>=75", '
+        '"Mobility<=13" or "HP=7"',
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        default=100_000,
+        help="Number of soldiers to estimate the probability with",
+    )
+    parser.add_argument(
+        "--pilot",
+        type=int,
+        help="Number of soldiers of every round of fitting the tilt; "
+        "by default, a tenth of -n",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument(
+        "--exact",
+        action="store_true",
+        help="Also work out the exact probability, of conditions on at most two stats",
+    )
+    args = parser.parse_args()
+    try:
+        conditions = [parse_condition(condition) for condition in args.conditions]
+    except ValueError as error:
+        parser.error(str(error))
+
+    initializer = INITIALIZERS[args.initializer]
+    estimate = tail_probability(
+        initializer, conditions, args.number, args.seed, args.confidence, args.pilot
+    )
+    print(f"Probability: {estimate.probability:.4g}")
+    if not estimate.probability:
+        print("No soldier met the conditions, which may not be possible at all")
+    print(
+        f"{args.confidence:.0%} confidence interval: "
+        f"[{estimate.low:.4g}, {estimate.high:.4g}]"
+    )
+    print(f"Relative error: {estimate.relative_error:.3g}")
+    if estimate.probability:
+        # Plain sampling has a relative error of sqrt((1 - p) / (n p))
+        naive = (1 - estimate.probability) / (
+            estimate.probability * estimate.relative_error**2
+        )
+        print(f"Soldiers plain sampling needs for that: {naive:.3g}")
+    if args.exact:
+        exact = exact_tail_probability(initializer, conditions)
+        if exact is None:
+            print("Exact: only for conditions on at most two stats")
+        else:
+            print(f"Exact: {exact:.4g}")
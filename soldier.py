@@ -1,7 +1,11 @@
 import random
-from collections import namedtuple
+import time
+from collections import Counter, namedtuple
 from functools import partial
-from typing import Sequence
+from typing import Collection, Sequence
+
+# How many times a swap is tried before giving up on the roll
+MAX_TRIES = 1000
 
 # TODO: Rename to StatRange?
 Stat = namedtuple(
@@ -181,45 +185,401 @@ class Soldier:
 Soldier.DEFAULT_WEIGHED_STAT_TOTAL = Soldier().weighed_stat_total()
 
 
+# Walker's alias method: draw an index uniformly, then keep it with
+# `probability[index]`, or take `alias[index]` instead
+AliasTable = namedtuple("AliasTable", ("probability", "alias"))
+
+
+def alias_table(weights: Sequence[float]) -> AliasTable:
+    """Vose's construction of the alias table of drawing indices by `weights`"""
+    total = sum(weights)
+    scaled = [weight * len(weights) / total for weight in weights]
+    probability = [1.0] * len(weights)
+    alias = list(range(len(weights)))
+    small = [i for i, weight in enumerate(scaled) if weight < 1]
+    large = [i for i, weight in enumerate(scaled) if weight >= 1]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        probability[less], alias[less] = scaled[less], more
+        scaled[more] -= 1 - scaled[less]
+        (small if scaled[more] < 1 else large).append(more)
+    # Whatever is left over is 1 up to rounding, and keeps probability 1
+    return AliasTable(tuple(probability), tuple(alias))
+
+
+def alias_draw(table: AliasTable, uniform: float) -> int:
+    """Draw an index from `table` with a single uniform number in [0, 1)"""
+    uniform *= len(table.probability)
+    index = int(uniform)
+    # The fraction left over is uniform too
+    return index if uniform - index < table.probability[index] else table.alias[index]
+
+
+def dice_sum_distribution(dice: Sequence[int]) -> list[float]:
+    """Probability of every sum of `dice`, indexed by the sum"""
+    distribution = [1.0]
+    for sides in dice:
+        rolled = [0.0] * (len(distribution) + sides)
+        for total, probability in enumerate(distribution):
+            for face in range(1, sides + 1):
+                rolled[total + face] += probability / sides
+        distribution = rolled
+    return distribution
+
+
+# Everything needed to roll soldiers with a `StatSwapper`, looked up once.
+# `swaps` are the swap table followed by its flips, and `ups`, `downs` are
+# the indices of their stats in `Soldier.STATS`.
+CompiledSwapper = namedtuple(
+    "CompiledSwapper",
+    (
+        "dice",
+        "swap_table",
+        "rolls",
+        "swaps",
+        "ups",
+        "up_amounts",
+        "downs",
+        "down_amounts",
+        "weights",
+        "swap_alias",
+    ),
+)
+
+
+def compile_swapper(dice: Sequence[int], swap_table: Sequence[StatSwap]):
+    swaps = tuple(swap_table) + tuple(
+        StatSwap(
+            swap.StatDown,
+            swap.StatDown_Amount,
+            swap.StatUp,
+            swap.StatUp_Amount,
+            swap.Weight,
+        )
+        for swap in swap_table
+    )
+    stat_indices = {stat: index for index, stat in enumerate(Soldier.STATS)}
+    weights = tuple(swap.Weight for swap in swaps)
+    return CompiledSwapper(
+        dice=tuple(dice),
+        swap_table=swap_table,
+        rolls=alias_table(dice_sum_distribution(dice)),
+        swaps=swaps,
+        ups=tuple(stat_indices[swap.StatUp] for swap in swaps),
+        up_amounts=tuple(swap.StatUp_Amount for swap in swaps),
+        downs=tuple(stat_indices[swap.StatDown] for swap in swaps),
+        down_amounts=tuple(swap.StatDown_Amount for swap in swaps),
+        weights=weights,
+        swap_alias=alias_table(weights) if swaps else None,
+    )
+
+
+# The swaps a soldier can apply, as indices into `SwapIndex.swaps`
+SwapSubset = namedtuple(
+    "SwapSubset", ("swaps", "alias", "failure", "indices", "valid_probability")
+)
+
+
+class SwapIndex:
+    """
+    Which swaps, in either direction, each stat allows at each of its deltas.
+    A soldier can apply exactly the swaps that all of its stats allow,
+    so swaps can be drawn from that subset instead of trying them all.
+    """
+
+    __slots__ = ["swap_table", "swaps", "total_weight", "allowed", "subsets"]
+
+    def __init__(self, compiled: CompiledSwapper):
+        self.swap_table = compiled.swap_table
+        self.swaps = compiled.swaps
+        self.total_weight = sum(swap.Weight for swap in self.swaps)
+
+        # Bit i of allowed[stat][delta] is set if stat allows self.swaps[i]
+        self.allowed: dict[str, dict[int, int]] = {}
+        for stat, range_ in Soldier.STATS.items():
+            self.allowed[stat] = {}
+            for delta in range(range_.min_delta, range_.max_delta + 1):
+                mask = 0
+                for i, swap in enumerate(self.swaps):
+                    # The same bounds checks as StatSwapper.try_swap
+                    if swap.StatUp == swap.StatDown == stat:
+                        swapped = delta + swap.StatUp_Amount - swap.StatDown_Amount
+                        allowed = range_.min_delta <= swapped <= range_.max_delta
+                    elif swap.StatUp == stat:
+                        allowed = delta + swap.StatUp_Amount <= range_.max_delta
+                    elif swap.StatDown == stat:
+                        allowed = delta - swap.StatDown_Amount >= range_.min_delta
+                    else:
+                        allowed = True
+                    mask |= allowed << i
+                self.allowed[stat][delta] = mask
+
+        self.subsets: dict[int, SwapSubset] = {}
+
+    def valid_swaps(self, sol: Soldier):
+        """
+        The swaps `sol` can apply, their alias table, and the chance
+        that all of `MAX_TRIES` tries draw a swap that can't be applied.
+        """
+        mask = (1 << len(self.swaps)) - 1
+        for stat, range_ in Soldier.STATS.items():
+            mask &= self.allowed[stat][getattr(sol, stat).current - range_.default]
+
+        try:
+            return self.subsets[mask]
+        except KeyError:
+            indices = [i for i in range(len(self.swaps)) if mask >> i & 1]
+            swaps = [self.swaps[i] for i in indices]
+            weights = [swap.Weight for swap in swaps]
+            valid_probability = sum(weights) / self.total_weight
+            failure = (1 - valid_probability) ** MAX_TRIES
+            self.subsets[mask] = SwapSubset(
+                swaps,
+                alias_table(weights) if swaps else None,
+                failure,
+                indices,
+                valid_probability,
+            )
+            return self.subsets[mask]
+
+
+class SamplerProfile:
+    """
+    What a sampler did, counted in terms of the loop of up to 1000 tries
+    of every roll: how many tries the rolls took, and which swaps those
+    tries drew and rejected. `batch.roll_soldiers` runs that loop, so its
+    tries are counted. `StatSwapper` draws from the swaps that fit instead,
+    so its tries and rejections are the numbers the loop is expected to
+    need, given the swaps that fit, and the profile is `expected`.
+    Swaps are indexed like `SwapIndex.swaps`: the table, then its flips.
+    """
+
+    __slots__ = [
+        "soldiers",
+        "rolls",
+        "tries",
+        "attempts",
+        "applied",
+        "rejected",
+        "exhausted",
+        "seconds",
+        "expected",
+    ]
+
+    def __init__(self, swap_count: int, expected: bool = False):
+        self.soldiers = 0
+        self.rolls = 0
+        self.tries = 0.0  # Of every roll together
+        # Tries per roll: number of rolls, where counted
+        self.attempts: Counter[int] = Counter()
+        self.applied = [0] * swap_count
+        self.rejected = [0.0] * swap_count
+        self.exhausted = 0  # Rolls where all of the tries failed
+        self.seconds = 0.0
+        # Whether the tries and rejections are expected rather than counted
+        self.expected = expected
+
+    def record(self, swap_index: SwapIndex, subset: SwapSubset, applied=None):
+        """
+        Record a roll of `StatSwapper` in state `subset`, which applied swap
+        `applied`, or nothing if that's None
+        """
+        self.rolls += 1
+        if applied is None:
+            tries = float(MAX_TRIES)
+            self.exhausted += 1
+        else:
+            # The expected tries up to the first that fits, given that one
+            # of them did: a geometric distribution cut off at MAX_TRIES
+            p = subset.valid_probability
+            tries = 1.0
+            if p < 1:
+                tries = 1 / p - MAX_TRIES * subset.failure / (1 - subset.failure)
+            self.applied[applied] += 1
+        self.tries += tries
+
+        rejections = tries - (applied is not None)
+        if rejections:
+            invalid_weight = swap_index.total_weight * (1 - subset.valid_probability)
+            valid = set(subset.indices)
+            for i, swap in enumerate(swap_index.swaps):
+                if i not in valid:
+                    self.rejected[i] += rejections * swap.Weight / invalid_weight
+
+    def count(
+        self,
+        soldiers: int,
+        tries: Collection[int],
+        applied: Collection[int],
+        rejected: Collection[int],
+        exhausted: int,
+    ):
+        """
+        Add the tries counted by `batch.roll_soldiers` for `soldiers`:
+        the number of rolls that took every number of tries, indexed by
+        that number, how many times every swap was applied and rejected,
+        and how many rolls ran out of tries
+        """
+        self.soldiers += soldiers
+        self.rolls += int(sum(tries))
+        self.tries += int(sum(attempts * rolls for attempts, rolls in enumerate(tries)))
+        self.attempts.update(
+            {attempts: int(rolls) for attempts, rolls in enumerate(tries) if rolls}
+        )
+        self.applied = [a + int(b) for a, b in zip(self.applied, applied)]
+        self.rejected = [a + int(b) for a, b in zip(self.rejected, rejected)]
+        self.exhausted += int(exhausted)
+
+    def merge(self, other: "SamplerProfile") -> "SamplerProfile":
+        if self.expected != other.expected:
+            raise ValueError("can't merge expected tries with counted ones")
+        self.soldiers += other.soldiers
+        self.rolls += other.rolls
+        self.tries += other.tries
+        self.attempts += other.attempts
+        self.applied = [a + b for a, b in zip(self.applied, other.applied)]
+        self.rejected = [a + b for a, b in zip(self.rejected, other.rejected)]
+        self.exhausted += other.exhausted
+        self.seconds += other.seconds
+        return self
+
+    def report(self, swap_table: Sequence[StatSwap]) -> str:
+        tries = "Expected tries" if self.expected else "Tries"
+        rejected = "expected rejected" if self.expected else "rejected"
+        # Counted rejections are whole numbers
+        decimals = 1 if self.expected else 0
+        lines = [
+            f"Soldiers: {self.soldiers} in {self.seconds:.3f} s",
+            f"Rolls: {self.rolls}, of which {self.exhausted} ran out of tries",
+            f"{tries}: {self.tries:.0f} "
+            f"({self.tries / max(self.rolls, 1):.2f} per roll)",
+        ]
+        if not self.expected:
+            lines.append(
+                "Tries per roll: "
+                + ", ".join(
+                    f"{attempts}: {rolls}"
+                    for attempts, rolls in sorted(self.attempts.items())
+                )
+            )
+        else:
+            lines.append(
+                "Tries per roll: not counted, only expected from the swaps that fit"
+            )
+        lines.append(
+            f"Swaps, most rejected first (row, direction, applied, {rejected}, "
+            "acceptance):"
+        )
+        rows = [
+            (i % len(swap_table), "flipped" if i >= len(swap_table) else "up")
+            for i in range(len(self.applied))
+        ]
+        for i in sorted(range(len(rows)), key=lambda i: -self.rejected[i]):
+            row, direction = rows[i]
+            tried = self.applied[i] + self.rejected[i]
+            acceptance = self.applied[i] / tried if tried else float("nan")
+            lines.append(
+                f"  {row:>3} {direction:<7} {self.applied[i]:>10} "
+                f"{self.rejected[i]:>14.{decimals}f} {acceptance:>8.2%}  "
+                f"{swap_table[row]}"
+            )
+        return "\n".join(lines)
+
+
 class StatSwapper:
-    __slots__ = ["dice", "swap_table"]
+    __slots__ = ["dice", "swap_table", "profile", "_compiled", "_swap_index"]
 
     def __init__(self, dice: Sequence[int] = (), swap_table: Sequence[StatSwap] = ()):
         self.dice = dice
         self.swap_table = swap_table
+        self.profile: SamplerProfile | None = None
+        self._compiled: CompiledSwapper | None = None
+        self._swap_index: SwapIndex | None = None
+
+    def compile(self) -> CompiledSwapper:
+        """
+        The compiled form of the current dice and swap table,
+        which is compiled again whenever either is replaced
+        """
+        if (
+            self._compiled is None
+            or self._compiled.swap_table is not self.swap_table
+            or self._compiled.dice != tuple(self.dice)
+        ):
+            self._compiled = compile_swapper(self.dice, self.swap_table)
+        return self._compiled
 
-    def __call__(self, sol: Soldier):
+    def swap_index(self) -> SwapIndex:
+        if (
+            self._swap_index is None
+            or self._swap_index.swap_table is not self.swap_table
+        ):
+            self._swap_index = SwapIndex(self.compile())
+        return self._swap_index
+
+    def start_profile(self) -> SamplerProfile:
+        """Start counting into a new `SamplerProfile`, until `stop_profile`"""
+        self.profile = SamplerProfile(len(self.compile().swaps), expected=True)
+        return self.profile
+
+    def stop_profile(self) -> SamplerProfile | None:
+        profile, self.profile = self.profile, None
+        return profile
+
+    def __call__(self, sol: Soldier, rng=random):
+        """
+        Roll the stats of `sol`, drawing from `rng`, which is the `random`
+        module by default, or a `random.Random` of its own
+        """
+        if self.profile is not None:
+            return self._profiled_call(sol, self.profile, rng)
+
+        swap_index = self.swap_index()
         # Roll for number of stats to apply
-        for __ in range(sum(random.randint(1, dice) for dice in self.dice)):
-            # Try 1000 times to find a suitable swap
-            for ___ in range(1000):
-                swap = random.choices(
-                    self.swap_table,
-                    weights=list(swap.Weight for swap in self.swap_table),
-                )[0]
-
-                # 50% chance to flip it around
-                if random.getrandbits(1):
-                    swap = StatSwap(
-                        swap.StatDown,
-                        swap.StatDown_Amount,
-                        swap.StatUp,
-                        swap.StatUp_Amount,
-                        swap.Weight,
-                    )
-                try:
-                    self.try_swap(sol, swap)
-                except RuntimeError:
-                    pass  # Swap not applied, try again
-                else:
-                    break  # Swap applied, exit inner loop
+        for __ in range(alias_draw(self.compile().rolls, rng.random())):
+            swaps, alias, failure, __, __ = swap_index.valid_swaps(sol)
+            if not swaps:
+                break  # No swap fits, so none will on the remaining rolls either
+
+            # Trying up to 1000 times to find a suitable swap, when 50% of them
+            # are flipped around, is the same as drawing one of the swaps that
+            # fit, unless all the tries fail
+            if failure and rng.random() < failure:
+                continue
+            self.apply_swap(sol, swaps[alias_draw(alias, rng.random())])
+
+    def _profiled_call(self, sol: Soldier, profile: SamplerProfile, rng=random):
+        """`__call__`, drawing the same random numbers, but counted in `profile`"""
+        start = time.perf_counter()
+        swap_index = self.swap_index()
+        rolls = alias_draw(self.compile().rolls, rng.random())
+        for roll in range(rolls):
+            subset = swap_index.valid_swaps(sol)
+            if not subset.swaps:
+                # Every remaining roll would have used up all of its tries
+                for __ in range(rolls - roll):
+                    profile.record(swap_index, subset)
+                break
+
+            if subset.failure and rng.random() < subset.failure:
+                profile.record(swap_index, subset)
+                continue
+            drawn = alias_draw(subset.alias, rng.random())
+            self.apply_swap(sol, subset.swaps[drawn])
+            profile.record(swap_index, subset, subset.indices[drawn])
+
+        profile.soldiers += 1
+        profile.seconds += time.perf_counter() - start
+
+    def apply_swap(self, sol: Soldier, swap: StatSwap):
+        getattr(sol, swap.StatUp).current += swap.StatUp_Amount
+        getattr(sol, swap.StatDown).current -= swap.StatDown_Amount
 
     def try_swap(self, sol: Soldier, swap: StatSwap):
         old_up = getattr(sol, swap.StatUp).current
         old_down = getattr(sol, swap.StatDown).current
 
-        getattr(sol, swap.StatUp).current += swap.StatUp_Amount
-        getattr(sol, swap.StatDown).current -= swap.StatDown_Amount
+        self.apply_swap(sol, swap)
 
         if (
             getattr(sol, swap.StatDown).current
@@ -1,15 +1,24 @@
 import argparse
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from textwrap import dedent
 from typing import Any
 
 import numpy as np
 import matplotlib as mpl
+
+mpl.use("Agg")  # Figures are only ever saved, never shown
+
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mtick
 from numpy.typing import NDArray
 
 
+from accumulator import sample_statistics
 from soldier import Soldier, INITIALIZERS
 
 COLORS = plt.rcParams["axes.prop_cycle"].by_key()["color"]
@@ -21,6 +30,9 @@ EXPLAINER = {
     "alpha": 0.5,
 }
 IMG_PREFIX = "img/SteamWorkshop"
+AGGREGATES_PATH = "SteamWorkshopAggregates.npz"
+# Bump when what's saved with the aggregates changes
+AGGREGATES_VERSION = 1
 
 AIM_RANGE = range(
     Soldier.STATS["Offense"].default + Soldier.STATS["Offense"].min_delta,
@@ -34,6 +46,12 @@ MOB_RANGE = range(
 INITIALIZER_1 = "lwotc"
 INITIALIZER_2 = "ancev3"
 
+# Everything the figures are drawn from, for one initializer.
+# Counts for samples, probabilities for exact distributions.
+Aggregates = namedtuple(
+    "Aggregates", ("marginals", "totals", "totals_weights", "correlation", "mob_aim")
+)
+
 
 class FigSaver:
     """
@@ -44,110 +62,166 @@ class FigSaver:
     count = 0
 
     @staticmethod
-    def save_fig(fig):
-        __class__.count += 1
+    def save_fig(fig, number=None):
+        """Save `fig` as figure `number`, or as the one after the last one saved"""
+        __class__.count = number or __class__.count + 1
         fig.savefig(f"{IMG_PREFIX}{str(__class__.count).zfill(2)}.png")
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser("python steam_workshop_images.py")
-    parser.add_argument(
-        "-n",
-        "--number",
-        type=int,
-        help="Number of soldiers to generate per sample",
+def aggregates(distribution) -> Aggregates:
+    """
+    The aggregates of an `exact.ExactDistribution` or of an
+    `accumulator.StatisticsAccumulator`, which have the same interface
+    """
+    totals, totals_weights = distribution.columns(totals=True)[-1]
+    nonzero = totals_weights > 0
+    return Aggregates(
+        marginals=distribution.marginals,
+        totals=totals[nonzero],
+        totals_weights=totals_weights[nonzero],
+        correlation=distribution.correlation(),
+        mob_aim=distribution.joint("Mobility", "Offense"),
     )
-    args = parser.parse_args()
 
+
+def compute_aggregates(
+    number: int | None,
+    exact: bool = False,
+    seed: int | None = None,
+    workers: int = 1,
+    cache: bool = False,
+    paired: bool = False,
+) -> list[Aggregates]:
+    """
+    The aggregates of `INITIALIZER_1` and `INITIALIZER_2`: of the exact
+    distributions, of coupled samples of `number` soldiers with `paired`,
+    or else of independent samples of `number` soldiers
+    """
+    keys = (INITIALIZER_1, INITIALIZER_2)
+    if exact:
+        from exact import exact_distribution
+
+        return [aggregates(exact_distribution(INITIALIZERS[key])) for key in keys]
+    if number is None:
+        raise ValueError("number is needed without exact")
+    if paired:
+        from paired import paired_statistics
+
+        statistics = paired_statistics(
+            {key: INITIALIZERS[key] for key in keys}, number, seed, workers
+        )
+        return [aggregates(statistics.statistics(key)) for key in keys]
+
+    # One independent stream per sample
+    seeds = np.random.SeedSequence(seed).spawn(2)
+    return [
+        aggregates(
+            sample_statistics(
+                INITIALIZERS[key],
+                number,
+                seed=seeds[sample_index],
+                workers=workers,
+                cache=cache,
+            )
+        )
+        for sample_index, key in enumerate(keys)
+    ]
+
+
+def save_aggregates(path, samples: list[Aggregates], parameters: dict):
+    """
+    Save the aggregates of `compute_aggregates` to an .npz file at `path`,
+    along with the `parameters` of `compute_aggregates` they come from
+    """
+    arrays: dict[str, Any] = {
+        "parameters": np.array(
+            json.dumps(
+                {
+                    "version": AGGREGATES_VERSION,
+                    "initializers": [INITIALIZER_1, INITIALIZER_2],
+                    **parameters,
+                }
+            )
+        )
+    }
+    for key, sample in zip((INITIALIZER_1, INITIALIZER_2), samples):
+        for stat, counts in sample.marginals.items():
+            arrays[f"{key}.marginals.{stat}"] = counts
+        for field in Aggregates._fields[1:]:
+            arrays[f"{key}.{field}"] = getattr(sample, field)
+    # Written under another name first, so that a failed run keeps the old file
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        np.savez(file, **arrays)
+    os.replace(temporary, path)
+
+
+def load_aggregates(path) -> tuple[list[Aggregates], dict]:
+    """The aggregates and parameters saved by `save_aggregates`"""
+    with np.load(path) as saved:
+        parameters = json.loads(str(saved["parameters"]))
+        if parameters["version"] != AGGREGATES_VERSION:
+            raise ValueError(
+                f"{path} has aggregates of version {parameters['version']}, "
+                f"not {AGGREGATES_VERSION}; compute them again"
+            )
+        samples = [
+            Aggregates(
+                marginals={
+                    stat: saved[f"{key}.marginals.{stat}"] for stat in Soldier.STATS
+                },
+                **{field: saved[f"{key}.{field}"] for field in Aggregates._fields[1:]},
+            )
+            for key in parameters["initializers"]
+        ]
+    return samples, parameters
+
+
+def set_style():
     plt.rcParams["legend.fancybox"] = False
     plt.rcParams["legend.framealpha"] = EXPLAINER["alpha"]
     plt.rcParams["legend.facecolor"] = EXPLAINER["facecolor"]
     plt.rcParams["legend.edgecolor"] = EXPLAINER["edgecolor"]
-    stat_figs = {}
-    stat_axes = {}
 
-    # Create figures/axes
-    for stat, range_ in Soldier.STATS.items():
-        fig, ax = plt.subplots()
-        stat_figs[stat], stat_axes[stat] = fig, ax
 
-    totals_fig, totals_ax = plt.subplots()
-    corr_fig, corr_axes = plt.subplot_mosaic(
-        [["top", "top_text"], ["bottom", "bottom_text"], ["colorbar", "colorbar"]],
-        width_ratios=[50, 50],
-        height_ratios=[40, 40, 10],
+def render_stat(stat, samples: list[Aggregates], label, scale):
+    """One of the 7 stat charts"""
+    fig, ax = plt.subplots()
+    range_ = Soldier.STATS[stat]
+    values = range(
+        range_.default + range_.min_delta, range_.default + range_.max_delta + 1
     )
-    mob_aim_fig, mob_aim_axes = plt.subplot_mosaic(
-        [["top", "colorbar"], ["bottom", "colorbar"]], width_ratios=[95, 5]
-    )
-    mob_aim_samples = []  # Need to plot after loop, otherwise colormap won't be shared
+    for sample_index, aggregates in enumerate(samples):
+        ax.bar(
+            x=[value - 0.75 / 4 + sample_index * 0.75 / 2 for value in values],
+            width=0.75 / 2,
+            height=aggregates.marginals[stat],
+            color=COLORS[sample_index],
+            edgecolor="black",
+            linewidth=0.75,
+        )
 
-    for sample_index, initializer in enumerate(
-        INITIALIZERS[key] for key in (INITIALIZER_1, INITIALIZER_2)
-    ):
-        # Put sample in a matrix
-        sample = np.zeros([args.number, len(Soldier.STATS)], dtype=np.int16)
-        totals = np.zeros([args.number], dtype=np.int16)
-        mob_aim_sample = np.zeros([len(MOB_RANGE), len(AIM_RANGE)], dtype=np.uint64)
-
-        # TODO: Refactor to use `main.generate_sample`
-        for i in range(args.number):
-            sol = Soldier(initializer)
-            sample[i, :] = [getattr(sol, stat).current for stat in Soldier.STATS]
-            totals[i] = sol.weighed_stat_total() - Soldier.DEFAULT_WEIGHED_STAT_TOTAL
-            mob_aim_sample[
-                getattr(sol, "Mobility").current - min(MOB_RANGE),
-                getattr(sol, "Offense").current - min(AIM_RANGE),
-            ] += 1
-
-        # The 7 stat charts
-        for stat_index, (stat, range_) in enumerate(Soldier.STATS.items()):
-            values = range(
-                range_.default + range_.min_delta, range_.default + range_.max_delta + 1
-            )
-            stat_axes[stat].bar(
-                x=[value - 0.75 / 4 + sample_index * 0.75 / 2 for value in values],
-                width=0.75 / 2,
-                height=[(sample[:, stat_index] == value).sum() for value in values],
-                color=COLORS[sample_index],
-                edgecolor="black",
-                linewidth=0.75,
-            )
+    ax.set_title(f"{stat} ({label})")
+    ax.yaxis.set_major_formatter(mtick.PercentFormatter(scale))
+    legend = ax.legend(["Base LWOTC", "Actually NCE"])
+    legend.get_frame().set_edgecolor(EXPLAINER["edgecolor"])
+    legend.get_frame().set_linewidth(EXPLAINER["linewidth"])
+    return fig
 
-        # Weighed Stat Total chart
-        if initializer is INITIALIZERS[INITIALIZER_2]:
-            totals_ax.hist(
-                totals,
-                color=COLORS[1],
-                edgecolor="black",
-                linewidth=0.75,
-            )
 
-        # Covariance matrices
-        cov = np.cov(sample.T)
-        cov /= np.sqrt(np.asmatrix(cov).diagonal().T * np.asmatrix(cov).diagonal())
-        corr_axes[("top", "bottom")[sample_index]].pcolor(
-            cov,
-            cmap=CORR_COLORMAP,
-            vmin=-max(abs(cov.min(None)), abs(cov.max(None))),
-            vmax=max(abs(cov.min(None)), abs(cov.max(None))),
-        )
+def render_totals(samples: list[Aggregates], label, scale):
+    """Weighed Stat Total chart, of the second initializer only"""
+    totals_fig, totals_ax = plt.subplots()
+    totals_ax.hist(
+        samples[1].totals,
+        weights=samples[1].totals_weights,
+        color=COLORS[1],
+        edgecolor="black",
+        linewidth=0.75,
+    )
 
-        # Aim/Mob correlation chart
-        mob_aim_samples.append(mob_aim_sample)
-
-    # Edit axes, save figs
-    for stat in Soldier.STATS:
-        ax = stat_axes[stat]
-        ax.set_title(f"{stat} (n = {args.number})")
-        ax.yaxis.set_major_formatter(mtick.PercentFormatter(args.number))
-        legend = ax.legend(["Base LWOTC", "Actually NCE"])
-        legend.get_frame().set_edgecolor(EXPLAINER["edgecolor"])
-        legend.get_frame().set_linewidth(EXPLAINER["linewidth"])
-        FigSaver.save_fig(stat_figs[stat])
-
-    totals_ax.set_title(f"Weighed Stat Totals (n = {args.number})")
-    totals_ax.yaxis.set_major_formatter(mtick.PercentFormatter(args.number))
+    totals_ax.set_title(f"Weighed Stat Totals ({label})")
+    totals_ax.yaxis.set_major_formatter(mtick.PercentFormatter(scale))
     totals_ax.set_ylim([0, totals_ax.get_ylim()[1] * 1.35])
     totals_ax.text(
         0.5,
@@ -161,12 +235,29 @@ if __name__ == "__main__":
             everything else is 1.
             """
         ).strip(),
-        transform=ax.transAxes,
+        transform=totals_ax.transAxes,
         verticalalignment="top",
         horizontalalignment="center",
         bbox=EXPLAINER,
     )
-    FigSaver.save_fig(totals_fig)
+    return totals_fig
+
+
+def render_correlation(samples: list[Aggregates], label, scale):
+    """Correlation matrices"""
+    corr_fig, corr_axes = plt.subplot_mosaic(
+        [["top", "top_text"], ["bottom", "bottom_text"], ["colorbar", "colorbar"]],
+        width_ratios=[50, 50],
+        height_ratios=[40, 40, 10],
+    )
+    for ax_key, aggregates in zip(("top", "bottom"), samples):
+        cov = aggregates.correlation
+        corr_axes[ax_key].pcolor(
+            cov,
+            cmap=CORR_COLORMAP,
+            vmin=-max(abs(cov.min(None)), abs(cov.max(None))),
+            vmax=max(abs(cov.min(None)), abs(cov.max(None))),
+        )
 
     for ax_key in ("top", "bottom"):
         ax = corr_axes[ax_key]
@@ -238,8 +329,15 @@ if __name__ == "__main__":
         labels=["More anticorrelated", "Uncorrelated", "More correlated"],
     )
     corr_fig.tight_layout()
-    FigSaver.save_fig(corr_fig)
+    return corr_fig
+
 
+def render_mob_aim(samples: list[Aggregates], label, scale):
+    """Aim/Mob correlation chart, on a shared colormap"""
+    mob_aim_fig, mob_aim_axes = plt.subplot_mosaic(
+        [["top", "colorbar"], ["bottom", "colorbar"]], width_ratios=[95, 5]
+    )
+    mob_aim_samples = [aggregates.mob_aim for aggregates in samples]
     mob_aim_max = max(sample.max(None) for sample in mob_aim_samples)
     for ax, sample in zip(
         [mob_aim_axes["top"], mob_aim_axes["bottom"]], np.array(mob_aim_samples)
@@ -257,8 +355,8 @@ if __name__ == "__main__":
         )
         ax.set_xlabel("Offense")
         ax.set_ylabel("Mobility")
-    mob_aim_axes["top"].set_title(f"Base LWOTC (n = {args.number})")
-    mob_aim_axes["bottom"].set_title(f"Actually NCE (n = {args.number})")
+    mob_aim_axes["top"].set_title(f"Base LWOTC ({label})")
+    mob_aim_axes["bottom"].set_title(f"Actually NCE ({label})")
 
     mob_aim_axes["colorbar"].set_axis_off()
     colorbar = mob_aim_fig.colorbar(
@@ -270,7 +368,136 @@ if __name__ == "__main__":
     )
     colorbar.set_ticks(
         [i / 5 for i in range(6)],
-        labels=[f"{100 * i * mob_aim_max / 5 / args.number}%" for i in range(6)],
+        labels=[f"{100 * i * mob_aim_max / 5 / scale}%" for i in range(6)],
     )
     mob_aim_fig.tight_layout()
-    FigSaver.save_fig(mob_aim_fig)
+    return mob_aim_fig
+
+
+# In the order they're numbered in
+FIGURES = [partial(render_stat, stat) for stat in Soldier.STATS] + [
+    render_totals,
+    render_correlation,
+    render_mob_aim,
+]
+
+
+def render_figure(number, samples: list[Aggregates], label, scale):
+    """Render and save figure `number` (counting from 1) of `FIGURES`"""
+    set_style()
+    fig = FIGURES[number - 1](samples, label, scale)
+    FigSaver.save_fig(fig, number)
+    plt.close(fig)
+
+
+def render_figures(samples: list[Aggregates], parameters: dict, workers: int = 1):
+    """Render every figure of `FIGURES` from aggregates, in `workers` processes"""
+    # Exact distributions are plotted as probabilities
+    scale = 1 if parameters["exact"] else parameters["number"]
+    label = "exact" if parameters["exact"] else f"n = {parameters['number']}"
+    numbers = range(1, len(FIGURES) + 1)
+    if workers == 1:
+        for number in numbers:
+            render_figure(number, samples, label, scale)
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            for future in [
+                pool.submit(render_figure, number, samples, label, scale)
+                for number in numbers
+            ]:
+                future.result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("python steam_workshop_images.py")
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        help="Number of soldiers to generate per sample",
+    )
+    parser.add_argument(
+        "--exact",
+        action="store_true",
+        help="Plot the exact distributions instead of samples",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to generate the samples with",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for the samples; the same seed gives the same images "
+        "with any number of workers",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Read the samples from, and save them to, the sample cache (needs --seed)",
+    )
+    parser.add_argument(
+        "--paired",
+        action="store_true",
+        help="Roll both samples from common random numbers, so that the "
+        "differences between them are less noisy (see paired.py)",
+    )
+    parser.add_argument(
+        "--aggregates",
+        default=AGGREGATES_PATH,
+        help="File the aggregates the figures are drawn from are saved to, "
+        "and read from by --render-only",
+    )
+    stages = parser.add_mutually_exclusive_group()
+    stages.add_argument(
+        "--compute-only",
+        action="store_true",
+        help="Only compute and save the aggregates, without rendering the figures",
+    )
+    stages.add_argument(
+        "--render-only",
+        action="store_true",
+        help="Only render the figures from the saved aggregates, "
+        "without computing them again",
+    )
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=1,
+        help="Number of processes to render the figures with",
+    )
+    args = parser.parse_args()
+    if args.render_workers < 1:
+        parser.error("--render-workers has to be positive")
+    if args.render_only:
+        try:
+            samples, parameters = load_aggregates(args.aggregates)
+        except (FileNotFoundError, ValueError) as error:
+            parser.error(str(error))
+    else:
+        if args.workers < 1:
+            parser.error("--workers has to be positive")
+        if args.cache and args.seed is None:
+            parser.error("--cache needs a --seed")
+        if args.cache and args.exact:
+            parser.error("--cache can't be used with --exact")
+        if args.paired and (args.exact or args.cache):
+            parser.error("--paired can't be used with --exact or --cache")
+        if args.number is None and not args.exact:
+            parser.error("-n is needed without --exact")
+        parameters = {
+            "number": args.number,
+            "exact": args.exact,
+            "seed": args.seed,
+            "paired": args.paired,
+        }
+        samples = compute_aggregates(
+            args.number, args.exact, args.seed, args.workers, args.cache, args.paired
+        )
+        save_aggregates(args.aggregates, samples, parameters)
+
+    if not args.compute_only:
+        render_figures(samples, parameters, args.render_workers)
@@ -0,0 +1,143 @@
+"""
+Statistics of every combination of a grid of initializers and dice.
+
+Every grid point is rolled and accumulated in its own worker process,
+and the results are written as one tidy table: a row for every stat and
+the weighed stat total of every configuration.
+
+    python sweep.py --initializers lwotc ancev3 --rolls 3d4 5d4 10d4 -n 100000
+"""
+import argparse
+import csv
+import json
+import math
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+from accumulator import sample_statistics
+from batch import STAT_NAMES
+from main import dice_notation
+from soldier import INITIALIZERS, StatSwapper
+
+COLUMN_NAMES = STAT_NAMES + ["WeighedStatTotal"]
+
+
+def sweep_point(initializer_name, rolls, n, seed=None, cache=False) -> list[dict]:
+    """The rows of the results table of one grid point"""
+    base = INITIALIZERS[initializer_name]
+    # A new swapper, so that the shared ones keep their dice
+    initializer = StatSwapper(
+        dice_notation(rolls) if rolls else base.dice, base.swap_table
+    )
+    statistics = sample_statistics(initializer, n, seed=seed, cache=cache)
+    mean = statistics.mean(totals=True)
+    variance = statistics.variance(totals=True)
+    skewness = statistics.skewness(totals=True)
+    correlation = statistics.correlation(totals=True)
+
+    rows = []
+    for i, stat in enumerate(COLUMN_NAMES):
+        row = {
+            "initializer": initializer_name,
+            "rolls": rolls or f"{len(base.dice)}d{base.dice[0]}",
+            "n": statistics.count,
+            "stat": stat,
+            "mean": mean[i],
+            "variance": variance[i],
+            "skewness": skewness[i],
+        }
+        row.update(
+            {f"corr_{other}": correlation[i, j] for j, other in enumerate(COLUMN_NAMES)}
+        )
+        # NaN for stats that never change, which JSON doesn't have
+        rows.append(
+            {
+                key: None if isinstance(value, float) and math.isnan(value) else value
+                for key, value in row.items()
+            }
+        )
+    return rows
+
+
+def write_rows(rows, file, format="csv"):
+    if format == "json":
+        json.dump(rows, file, indent=2)
+        file.write("\n")
+    else:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def sweep(initializer_names, rolls, n, seed=None, cache=False, workers=1):
+    """All rows of the results table, in grid order"""
+    grid = list(product(initializer_names, rolls))
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [
+            pool.submit(sweep_point, name, point_rolls, n, seed, cache)
+            for name, point_rolls in grid
+        ]
+        return [row for future in futures for row in future.result()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("python sweep.py")
+    parser.add_argument(
+        "--initializers",
+        nargs="+",
+        choices=INITIALIZERS,
+        default=list(INITIALIZERS),
+        help="Initializers to sweep over",
+    )
+    parser.add_argument(
+        "--rolls",
+        nargs="+",
+        default=[None],
+        help="Dice to sweep over, like 5d4; by default, each initializer's own",
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        help="Number of soldiers per grid point",
+        required=True,
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Read the samples from, and save them to, the sample cache (needs --seed)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of grid points to roll at once; by default, one per CPU",
+    )
+    parser.add_argument("--format", choices=("csv", "json"), default="csv")
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        help="Write the table to this file instead of stdout",
+    )
+    args = parser.parse_args()
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers has to be positive")
+    if args.cache and args.seed is None:
+        parser.error("--cache needs a --seed")
+    for rolls in args.rolls:
+        if rolls is not None:
+            try:
+                dice_notation(rolls)
+            except ValueError:
+                parser.error(f"invalid dice notation: {rolls}")
+
+    rows = sweep(
+        args.initializers, args.rolls, args.number, args.seed, args.cache, args.workers
+    )
+    if args.output:
+        with open(args.output, "w", newline="") as file:
+            write_rows(rows, file, args.format)
+    else:
+        write_rows(rows, sys.stdout, args.format)